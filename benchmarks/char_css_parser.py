@@ -0,0 +1,104 @@
+# The original character-by-character CSS parser from browser.py, kept as a
+# reference for css_bench.py to measure the regex-based CSSParser against.
+
+from browser import TagSelector, DescendantSelector
+
+class CharCSSParser:
+    def __init__(self, s):
+        self.s = s
+        self.i = 0
+    
+    # Increment index past every whitespace character
+    def whitespace(self):
+        while self.i < len(self.s) and self.s[self.i].isspace():
+            self.i += 1
+
+    # Increment index through any word character and store parsed data
+    # from where the function started to where it move
+    def word(self):
+        start = self.i
+        while self.i < len(self.s):
+            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
+                self.i += 1
+            else:
+                break
+        if not (self.i > start):
+            raise Exception("index i hasn't advanced")
+        return self.s[start:self.i]
+
+    # Increment index through a literal (e.g. ':')
+    def literal(self, literal):
+        if not (self.i < len(self.s) and self.s[self.i] == literal):
+            raise Exception("Not a literal")
+        self.i += 1
+    
+    # Parse property-value pair
+    def pair(self):
+        prop = self.word()
+        self.whitespace()
+        self.literal(':')
+        self.whitespace()
+        val = self.word()
+        return prop.casefold(), val
+    
+    # Parse sequences (e.g. 'style' attributes are a sequence of property-value pairs)
+    def body(self):
+        pairs = {}
+        while self.i < len(self.s) and self.s[self.i] != "}":
+            try:
+                prop, val = self.pair()
+                pairs[prop.casefold()] = val
+                self.whitespace()
+                self.literal(';')
+                self.whitespace()
+            except Exception:
+                why = self.ignore_until([';', "}"])
+                if why == ";":
+                    self.literal(";")
+                    self.whitespace()
+                else:
+                    break
+
+        return pairs
+
+    # Ignore at a character from a given character set 
+    # in order to ignore certain property-value pairs
+    def ignore_until(self, chars): 
+        while self.i < len(self.s):
+            if self.s[self.i] in chars:
+                return self.s[self.i]
+            else:
+                self.i += 1
+        return None
+    
+    # Function to parse selectors
+    def selector(self):
+        out = TagSelector(self.word().casefold())
+        self.whitespace()
+        while self.i < len(self.s) and self.s[self.i] != "{":
+            tag = self.word()
+            descendant = TagSelector(tag.casefold())
+            out = DescendantSelector(out, descendant)
+            self.whitespace()
+        return out
+
+    # Parse a sequence of selectors and block (a CSS file)
+    def parse(self):
+        rules = []
+        while self.i < len(self.s):
+            try:
+                self.whitespace()
+                selector = self.selector()
+                self.literal("{")
+                self.whitespace()
+                body = self.body()
+                self.literal("}")
+                rules.append((selector, body))
+            except Exception:
+                why = self.ignore_until(["}"])
+                if why == "}":
+                    self.literal("}")
+                    self.whitespace()
+                else:
+                    break
+        return rules
@@ -0,0 +1,107 @@
+# Compares the regex-based CSSParser against the original
+# character-by-character parser on large synthetic stylesheets, and checks
+# that both produce the same rules where the old parser's grammar applies.
+# The comment-run fixture guards against the scanners backtracking.
+#
+#   python benchmarks/css_bench.py [rules] [repeat]
+
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+from browser import CSSParser, DescendantSelector
+from char_css_parser import CharCSSParser
+
+TAGS = ["html", "body", "div", "p", "a", "span", "ul", "li", "pre", "code",
+        "h1", "h2", "nav", "header", "footer", "section", "article", "input"]
+PROPERTIES = ["color", "background-color", "font-size", "font-weight",
+              "font-style", "margin", "padding", "display", "width"]
+VALUES = ["red", "#333", "#ffeedd", "12px", "110%", "bold", "italic",
+          "none", "block", "inline", "0", "1.5em", "auto"]
+
+# Single-word values only, which both parsers understand
+def simple_sheet(n, rng):
+    out = []
+    for _ in range(n):
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.randint(1, 3)))
+        decls = " ".join(
+            "{}: {};".format(rng.choice(PROPERTIES), rng.choice(VALUES))
+            for _ in range(rng.randint(1, 6)))
+        out.append("{} {{ {} }}".format(selector, decls))
+    return "\n".join(out)
+
+# Adds comments, strings, multi-token values and malformed rules
+def real_world_sheet(n, rng):
+    out = []
+    for i in range(n):
+        if i % 10 == 0:
+            out.append("/* section {} -- {{ not a rule }} */".format(i))
+        if i % 25 == 0:
+            out.append("a:hover, a:focus { color: blue; }")
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.randint(1, 3)))
+        decls = [
+            "font-family: \"Times New Roman\", serif;",
+            "margin: 0 auto 1em /* inline */ auto;",
+            "{}: {};".format(rng.choice(PROPERTIES), rng.choice(VALUES)),
+            "border: 1px solid #ccc",
+        ]
+        out.append("{} {{\n  {}\n}}".format(selector, "\n  ".join(decls)))
+    return "\n".join(out)
+
+# Long runs of comments between selector words and inside values, which
+# took exponential time while comments could be split more than one way
+def comment_run_sheet(n):
+    comments = "/* old rule */\n" * n
+    return "\n".join([
+        "h1\n" + comments + ", h2 { color: red }",
+        "h1 " + comments + "h2 { color: " + comments + "red }",
+        "p { margin: 0 " + comments + "auto",
+    ])
+
+def describe(selector):
+    if isinstance(selector, DescendantSelector):
+        return describe(selector.ancestor) + " " + describe(selector.descendant)
+    return selector.tag
+
+def normalize(rules):
+    return [(describe(selector), body) for selector, body in rules]
+
+def timed(parser, text, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        rules = parser(text).parse()
+        best = min(best, time.perf_counter() - start)
+    return best, rules
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    rng = random.Random(0)
+
+    with open(os.path.join(ROOT, "browser.css")) as f:
+        fixtures = [("browser.css", f.read())]
+    fixtures.append(("simple", simple_sheet(n, rng)))
+    fixtures.append(("real-world", real_world_sheet(n, rng)))
+    fixtures.append(("comment-run", comment_run_sheet(n)))
+
+    print("{:<12} {:>10} {:>12} {:>12} {:>8}".format(
+        "fixture", "bytes", "char (ms)", "scan (ms)", "speedup"))
+    for name, text in fixtures:
+        old_time, old_rules = timed(CharCSSParser, text, repeat)
+        new_time, new_rules = timed(CSSParser, text, repeat)
+        if name in ("browser.css", "simple") and normalize(old_rules) != normalize(new_rules):
+            print("{}: parsers disagree".format(name))
+            sys.exit(1)
+        print("{:<12} {:>10} {:>12.1f} {:>12.1f} {:>7.1f}x".format(
+            name, len(text), old_time * 1000, new_time * 1000,
+            old_time / new_time))
+
+if __name__ == "__main__":
+    main()
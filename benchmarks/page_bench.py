@@ -0,0 +1,218 @@
+# End-to-end page-load benchmark. Serves the page_fixtures.py corpus from a
+# loopback HTTP server and runs each page through the browser pipeline,
+# timing every stage separately: URL.request, HTMLParser.parse,
+# CSSParser.parse, style, DocumentLayout.layout and paint_tree. A separate
+# pass under tracemalloc records peak memory, so tracing doesn't skew the
+# timings.
+#
+#   python benchmarks/page_bench.py                     # print results
+#   python benchmarks/page_bench.py --save-baseline     # store a baseline
+#   python benchmarks/page_bench.py --check             # compare against it
+#
+# Layout and paint measure text with Tk fonts, so they are skipped (and
+# reported as null) when Tk can't open a display. A baseline can only be
+# saved from a run with a display.
+
+import argparse
+import http.server
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+
+import tkinter
+import browser
+import page_fixtures
+
+STAGES = ["request", "html_parse", "css_parse", "style", "layout", "paint"]
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "page_baseline.json")
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which would otherwise
+    # wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_corpus(corpus):
+    class Handler(FixtureHandler):
+        def do_GET(self):
+            body = corpus.get(self.path.lstrip("/"))
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Runs one page through the pipeline, returning the time spent in each stage
+# and the objects it produced
+def load_page(url, can_layout):
+    timings = dict.fromkeys(STAGES, 0.0)
+
+    start = time.perf_counter()
+    body = url.request()
+    timings["request"] += time.perf_counter() - start
+
+    start = time.perf_counter()
+    nodes = browser.HTMLParser(body).parse()
+    timings["html_parse"] = time.perf_counter() - start
+
+    rules = list(browser.DEFAULT_STYLE_SHEET)
+    for node in browser.walk_tree(nodes):
+        if not (isinstance(node, browser.Element) and node.tag == "link"
+                and node.attributes.get("rel") == "stylesheet"): continue
+        start = time.perf_counter()
+        text = url.resolve(node.attributes["href"]).request()
+        timings["request"] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        rules.extend(browser.CSSParser(text).parse())
+        timings["css_parse"] += time.perf_counter() - start
+    rules.sort(key=browser.cascade_priority)
+
+    start = time.perf_counter()
+    browser.style(nodes, rules)
+    timings["style"] = time.perf_counter() - start
+
+    document = None
+    display_list = []
+    if can_layout:
+        start = time.perf_counter()
+        document = browser.DocumentLayout(nodes)
+        document.layout()
+        timings["layout"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        browser.paint_tree(document, display_list)
+        timings["paint"] = time.perf_counter() - start
+    else:
+        timings["layout"] = timings["paint"] = None
+    return timings, (nodes, document, display_list)
+
+def measure_memory(url, can_layout):
+    tracemalloc.start()
+    _, (nodes, document, display_list) = load_page(url, can_layout)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "peak_kb": peak / 1024,
+        "retained_kb": retained / 1024,
+        "dom_nodes": sum(1 for _ in browser.walk_tree(nodes)),
+        "layout_objects": sum(1 for _ in browser.walk_tree(document)) if document else None,
+        "draw_commands": len(display_list),
+    }
+
+def run(repeat, can_layout):
+    corpus = {name: text.encode("utf-8") for name, text in page_fixtures.corpus().items()}
+    server = serve_corpus(corpus)
+    base = "http://127.0.0.1:{}/".format(server.server_address[1])
+    results = {}
+    try:
+        for page in page_fixtures.PAGES:
+            url = browser.URL(base + page)
+            load_page(url, can_layout)      # Warm up connections and caches
+            samples = [load_page(url, can_layout)[0] for _ in range(repeat)]
+            stages = {}
+            for stage in STAGES:
+                values = [sample[stage] for sample in samples]
+                if values[0] is None:
+                    stages[stage] = None
+                    continue
+                stages[stage] = {
+                    "median_ms": statistics.median(values) * 1000,
+                    "min_ms": min(values) * 1000,
+                }
+            results[page] = {
+                "bytes": len(corpus[page]),
+                "stages": stages,
+                "memory": measure_memory(url, can_layout),
+            }
+    finally:
+        server.shutdown()
+    return results
+
+# A stage regresses when its median is both threshold (a fraction) and
+# min_ms slower than the baseline's, so tiny stages don't trip on noise
+def regressions(results, baseline, threshold, min_ms):
+    found = []
+    for page, result in results.items():
+        old_page = baseline.get("pages", {}).get(page)
+        if not old_page: continue
+        for stage, timing in result["stages"].items():
+            old = old_page["stages"].get(stage)
+            if not timing or not old: continue
+            new_ms, old_ms = timing["median_ms"], old["median_ms"]
+            if new_ms > old_ms * (1 + threshold) and new_ms - old_ms > min_ms:
+                found.append({"page": page, "stage": stage,
+                              "baseline_ms": old_ms, "current_ms": new_ms})
+        old_peak = old_page.get("memory", {}).get("peak_kb")
+        new_peak = result["memory"]["peak_kb"]
+        if old_peak and new_peak > old_peak * (1 + threshold):
+            found.append({"page": page, "stage": "memory",
+                          "baseline_kb": old_peak, "current_kb": new_peak})
+    return found
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end page-load benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="timed loads per page")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline JSON file")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store this run as the baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with status 1 if a stage regressed")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed slowdown as a fraction of the baseline")
+    parser.add_argument("--min-ms", type=float, default=1.0,
+                        help="ignore slowdowns smaller than this many milliseconds")
+    parser.add_argument("-o", "--output", help="write the JSON results here")
+    args = parser.parse_args()
+
+    try:
+        tkinter.Tk().withdraw()
+        can_layout = True
+    except tkinter.TclError:
+        print("No display; skipping layout and paint", file=sys.stderr)
+        can_layout = False
+    if args.save_baseline and not can_layout:
+        parser.error("--save-baseline needs a display, so that layout and paint are timed")
+
+    report = {"layout": can_layout, "pages": run(args.repeat, can_layout)}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        report["regressions"] = regressions(
+            report["pages"], baseline, args.threshold, args.min_ms)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+        print("Saved baseline to", args.baseline, file=sys.stderr)
+
+    for regression in report.get("regressions", []):
+        print("Regression:", regression, file=sys.stderr)
+    if args.check and report.get("regressions"):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
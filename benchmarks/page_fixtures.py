@@ -0,0 +1,103 @@
+# Generates the page corpus used by page_bench.py: large CJK text, deeply
+# nested markup, a CSS-heavy page and a form. Pages are generated from a
+# fixed seed, so every run (and every machine) sees the same bytes.
+#
+#   python benchmarks/page_fixtures.py [directory]
+
+import os
+import random
+import sys
+
+SEED = 20240601
+
+TAGS = ["div", "p", "span", "b", "i", "a", "ul", "li", "pre", "code", "small", "big"]
+WORDS = ["browser", "engine", "layout", "style", "paint", "canvas", "token",
+         "parser", "network", "socket", "cache", "render", "frame", "scroll"]
+
+# A long novel-style page of Chinese text, like xiyouji.html: few spaces,
+# so each paragraph is a handful of very long words
+def cjk_page(rng, paragraphs=300, length=220):
+    out = ["<!doctype html><html><head><title>西遊記</title></head><body>"]
+    out.append("<h1>第一回 靈根育孕源流出 心性修持大道生</h1>")
+    for _ in range(paragraphs):
+        chars = []
+        for i in range(length):
+            if i % 23 == 22:
+                chars.append(rng.choice("，。；：、！？ "))
+            else:
+                chars.append(chr(rng.randint(0x4E00, 0x9FA5)))
+        out.append("<p>" + "".join(chars) + "</p>")
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def nested_page(rng, depth=1500):
+    out = ["<!doctype html><html><body>"]
+    for i in range(depth):
+        out.append("<div>" + ("level {} ".format(i) if i % 50 == 0 else ""))
+    out.append("<p>" + " ".join(rng.choice(WORDS) for _ in range(40)) + "</p>")
+    out.append("</div>" * depth)
+    out.append("</body></html>")
+    return "".join(out)
+
+def css_heavy_sheet(rng, rules=4000):
+    properties = ["color", "background-color", "font-size", "font-weight", "font-style"]
+    values = {
+        "color": ["black", "#333", "#0000ff", "green"],
+        "background-color": ["white", "#eeeeee", "lightblue", "transparent"],
+        "font-size": ["12px", "16px", "90%", "120%"],
+        "font-weight": ["normal", "bold"],
+        "font-style": ["normal", "italic"],
+    }
+    out = []
+    for i in range(rules):
+        if i % 40 == 0:
+            out.append("/* block {} */".format(i))
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.randint(1, 3)))
+        decls = []
+        for _ in range(rng.randint(1, 5)):
+            prop = rng.choice(properties)
+            decls.append("{}: {};".format(prop, rng.choice(values[prop])))
+        out.append("{} {{ {} }}".format(selector, " ".join(decls)))
+    return "\n".join(out)
+
+def css_heavy_page(rng, elements=1500):
+    out = ['<!doctype html><html><head><link rel="stylesheet" href="css_heavy.css"></head><body>']
+    for _ in range(elements // 3):
+        outer, inner = rng.choice(["div", "ul", "p"]), rng.choice(["span", "b", "i", "code"])
+        words = " ".join(rng.choice(WORDS) for _ in range(8))
+        out.append("<{0}><{1}>{2}</{1}> {2}</{0}>".format(outer, inner, words))
+    out.append("</body></html>")
+    return "\n".join(out)
+
+def form_page(rng, fields=400):
+    out = ["<!doctype html><html><body><form action=/add method=post>"]
+    for i in range(fields):
+        out.append("<p>{} <input name=field{} value={}></p>".format(
+            rng.choice(WORDS), i, rng.choice(WORDS)))
+    out.append("<p><button>Submit</button></p></form></body></html>")
+    return "\n".join(out)
+
+# File name to contents, for every file in the corpus
+def corpus():
+    rng = random.Random(SEED)
+    return {
+        "cjk.html": cjk_page(rng),
+        "nested.html": nested_page(rng),
+        "css_heavy.css": css_heavy_sheet(rng),
+        "css_heavy.html": css_heavy_page(rng),
+        "form.html": form_page(rng),
+    }
+
+# The pages to load, in order
+PAGES = ["cjk.html", "nested.html", "css_heavy.html", "form.html"]
+
+def write_corpus(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name, text in corpus().items():
+        with open(os.path.join(directory, name), "w", encoding="utf-8") as f:
+            f.write(text)
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else "fixtures"
+    write_corpus(directory)
+    print("Wrote {} files to {}".format(len(corpus()), directory))
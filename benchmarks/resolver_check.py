@@ -0,0 +1,124 @@
+# Checks the DNS resolver and connection racing against a loopback server,
+# with getaddrinfo replaced by a stub so that no real lookups happen:
+#
+#   ordering   addresses alternate between families, without duplicates
+#   ttl        answers are reused until DNS_TTL runs out, then looked up again
+#   timeout    a lookup that hangs fails after the connect timeout
+#   fallback   a refused address falls back to the next one, and a failed
+#              connection makes the next request look the name up again
+#
+#   python benchmarks/resolver_check.py
+
+import http.server
+import os
+import socket
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+import browser
+
+BODY = b"resolver check"
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, format, *args):
+        pass
+
+# A getaddrinfo that answers from a table and counts its lookups
+class StubDNS:
+    def __init__(self, table, delay=0):
+        self.table = table
+        self.delay = delay
+        self.lookups = 0
+
+    def __call__(self, host, port, type=0):
+        self.lookups += 1
+        time.sleep(self.delay)
+        if host not in self.table:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(family, type, 0, "", address) for family, address in self.table[host]]
+
+def check_ordering():
+    v4, v6 = socket.AF_INET, socket.AF_INET6
+    dns = StubDNS({"example.test": [
+        (v6, ("::1", 80, 0, 0)), (v6, ("::2", 80, 0, 0)),
+        (v4, ("127.0.0.1", 80)), (v6, ("::1", 80, 0, 0)), (v4, ("127.0.0.2", 80)),
+    ]})
+    addresses = browser.Resolver(dns).resolve("example.test", 80)
+    return [address[0] for _, address in addresses] == ["::1", "127.0.0.1", "::2", "127.0.0.2"]
+
+def check_ttl():
+    dns = StubDNS({"example.test": [(socket.AF_INET, ("127.0.0.1", 80))]})
+    resolver = browser.Resolver(dns, ttl=0.2)
+    resolver.resolve("example.test", 80)
+    resolver.resolve("example.test", 80)
+    cached = dns.lookups == 1
+    time.sleep(0.3)
+    resolver.resolve("example.test", 80)
+    return cached and dns.lookups == 2
+
+def check_timeout():
+    dns = StubDNS({"example.test": [(socket.AF_INET, ("127.0.0.1", 80))]}, delay=2)
+    start = time.monotonic()
+    try:
+        browser.Resolver(dns).resolve("example.test", 80, timeout=0.2)
+    except TimeoutError:
+        return time.monotonic() - start < 1
+    return False
+
+def check_fallback(port):
+    # Nothing listens on 127.0.0.2, so connecting there is refused
+    refused = (socket.AF_INET, ("127.0.0.2", port))
+    listening = (socket.AF_INET, ("127.0.0.1", port))
+    dns = StubDNS({"example.test": [refused, listening]})
+    browser.URL.resolver = browser.Resolver(dns)
+    url = "http://example.test:{}/".format(port)
+    fell_back = browser.URL(url).request(binary=True) == BODY
+
+    dns.table["example.test"] = [refused]
+    browser.URL.resolver.forget("example.test", port)
+    browser.CONNECTIONS.idle.clear()
+    try:
+        browser.URL(url + "again").request(binary=True)
+        failed = False
+    except ConnectionRefusedError:
+        failed = True
+    dns.table["example.test"] = [listening]
+    lookups = dns.lookups
+    recovered = browser.URL(url + "later").request(binary=True) == BODY
+    return fell_back and failed and recovered and dns.lookups == lookups + 1
+
+def main():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    checks = [
+        ("ordering", check_ordering),
+        ("ttl", check_ttl),
+        ("timeout", check_timeout),
+        ("fallback", lambda: check_fallback(server.server_address[1])),
+    ]
+    failed = False
+    try:
+        for name, check in checks:
+            ok = check()
+            failed = failed or not ok
+            print("{:<10} {}".format(name, "ok" if ok else "FAILED"))
+    finally:
+        server.shutdown()
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
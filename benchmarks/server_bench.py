@@ -0,0 +1,292 @@
+# Load generator for server.py. Starts the server on a free local port with
+# a scratch entry log, drives it with a mix of GET / and POST /add requests,
+# and reports throughput and latency percentiles as JSON.
+#
+#   python benchmarks/server_bench.py --clients 16 --duration 10
+#   python benchmarks/server_bench.py --rate 2000 --no-keep-alive -o run.json
+#   python benchmarks/server_bench.py --gzip       # like the browser, which accepts gzip
+#
+# Without --rate the load is closed-loop: each client sends its next request
+# as soon as the previous response arrives. With --rate it is open-loop:
+# requests are scheduled at a fixed rate regardless of how fast the server
+# answers, and latency is measured from the scheduled time, so queueing
+# delay shows up in the numbers instead of silently lowering the load.
+
+import argparse
+import json
+import os
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+HISTOGRAM_BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_server(port, log_path):
+    code = "import server; server.serve({}, log_path={!r})".format(port, log_path)
+    process = subprocess.Popen(
+        [sys.executable, "-c", code], cwd=ROOT,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server did not start")
+
+# A client connection that reads responses well enough to frame them, so a
+# kept-alive socket can carry the next request
+class Client:
+    def __init__(self, port, keep_alive, gzip=False):
+        self.port = port
+        self.keep_alive = keep_alive
+        self.gzip = gzip
+        self.sock = None
+        self.file = None
+
+    def connect(self):
+        self.sock = socket.create_connection(("127.0.0.1", self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.file = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock:
+            self.file.close()
+            self.sock.close()
+        self.sock = self.file = None
+
+    def request(self, method, path, body=None):
+        if not self.sock:
+            self.connect()
+        request = "{} {} HTTP/1.1\r\nHost: localhost\r\n".format(method, path)
+        if not self.keep_alive:
+            request += "Connection: close\r\n"
+        if self.gzip:
+            request += "Accept-Encoding: gzip\r\n"
+        if body is not None:
+            request += "Content-Type: application/x-www-form-urlencoded\r\n"
+            request += "Content-Length: {}\r\n".format(len(body))
+        request = (request + "\r\n").encode("latin-1") + (body or b"")
+        try:
+            self.sock.sendall(request)
+            return self.read_response()
+        except OSError:
+            self.close()
+            raise
+
+    def read_response(self):
+        statusline = self.file.readline()
+        if not statusline:
+            raise ConnectionError("connection closed")
+        status = int(statusline.split(b" ", 2)[1])
+        headers = {}
+        while True:
+            line = self.file.readline()
+            if line in (b"\r\n", b""): break
+            header, value = line.decode("latin-1").split(":", 1)
+            headers[header.casefold()] = value.strip()
+        if headers.get("transfer-encoding") == "chunked":
+            size = 0
+            while True:
+                length = int(self.file.readline().split(b";")[0], 16)
+                if length == 0:
+                    while self.file.readline() not in (b"\r\n", b""): pass
+                    break
+                size += len(self.file.read(length))
+                self.file.readline()
+        else:
+            size = len(self.file.read(int(headers.get("content-length", 0))))
+        if not self.keep_alive or headers.get("connection", "").casefold() == "close":
+            self.close()
+        return status, size
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"GET": [], "POST": []}
+        self.errors = 0
+        self.bytes = 0
+
+    def record(self, kind, latency, size):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            self.bytes += size
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+
+def choose_request(rng, post_ratio, counter):
+    if rng.random() < post_ratio:
+        body = "guest=bench+entry+{}".format(next(counter)).encode("latin-1")
+        return "POST", "/add", body
+    return "GET", "/", None
+
+def send(client, results, rng, args, counter, scheduled=None):
+    method, path, body = choose_request(rng, args.post_ratio, counter)
+    start = time.perf_counter() if scheduled is None else scheduled
+    try:
+        status, size = client.request(method, path, body)
+    except (OSError, ValueError):
+        results.error()
+        return
+    # Posts redirect back to the page, which isn't followed
+    if status != (303 if method == "POST" else 200):
+        results.error()
+        return
+    results.record(method, time.perf_counter() - start, size)
+
+def closed_loop(args, port, results, deadline):
+    counter = iter(range(1 << 62))
+    def run(seed):
+        rng = random.Random(seed)
+        client = Client(port, args.keep_alive, args.gzip)
+        while time.perf_counter() < deadline:
+            send(client, results, rng, args, counter)
+        client.close()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.clients)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+
+def open_loop(args, port, results, deadline):
+    counter = iter(range(1 << 62))
+    schedule = queue.Queue()
+    def run(seed):
+        rng = random.Random(seed)
+        client = Client(port, args.keep_alive, args.gzip)
+        while True:
+            scheduled = schedule.get()
+            if scheduled is None: break
+            send(client, results, rng, args, counter, scheduled)
+        client.close()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(args.clients)]
+    for thread in threads: thread.start()
+
+    interval = 1 / args.rate
+    next_time = time.perf_counter()
+    while next_time < deadline:
+        delay = next_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        schedule.put(next_time)
+        next_time += interval
+    for _ in threads: schedule.put(None)
+    for thread in threads: thread.join()
+
+def percentile(ordered, fraction):
+    if not ordered: return None
+    index = min(int(fraction * len(ordered)), len(ordered) - 1)
+    return ordered[index]
+
+def summarize(latencies, elapsed):
+    ordered = sorted(latency * 1000 for latency in latencies)
+    histogram = {}
+    i = 0
+    for bound in HISTOGRAM_BUCKETS + [float("inf")]:
+        count = 0
+        while i < len(ordered) and ordered[i] <= bound:
+            count += 1
+            i += 1
+        histogram["le_{}".format(bound)] = count
+    return {
+        "requests": len(ordered),
+        "throughput": len(ordered) / elapsed if elapsed else 0,
+        "mean_ms": sum(ordered) / len(ordered) if ordered else None,
+        "p50_ms": percentile(ordered, 0.50),
+        "p95_ms": percentile(ordered, 0.95),
+        "p99_ms": percentile(ordered, 0.99),
+        "max_ms": ordered[-1] if ordered else None,
+        "histogram_ms": histogram,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for server.py")
+    parser.add_argument("--clients", type=int, default=8,
+                        help="concurrent client connections")
+    parser.add_argument("--duration", type=float, default=5,
+                        help="seconds of measured load")
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="seconds of unmeasured load before measuring")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="requests per second for open-loop load")
+    parser.add_argument("--post-ratio", type=float, default=0.05,
+                        help="fraction of requests that are POST /add")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="open a new connection for every request")
+    parser.add_argument("--gzip", action="store_true",
+                        help="send Accept-Encoding: gzip, as the browser does")
+    parser.add_argument("--entries", type=int, default=1000,
+                        help="guestbook entries to add before measuring")
+    parser.add_argument("--port", type=int, default=None,
+                        help="benchmark a server already running on this port")
+    parser.add_argument("-o", "--output", help="write the JSON results here")
+    args = parser.parse_args()
+
+    server = None
+    scratch = tempfile.TemporaryDirectory()
+    port = args.port
+    if port is None:
+        port = free_port()
+        server = start_server(port, os.path.join(scratch.name, "guestbook.log"))
+
+    try:
+        client = Client(port, True)
+        for i in range(args.entries):
+            client.request("POST", "/add", "guest=seed+{}".format(i).encode("latin-1"))
+        client.close()
+
+        drive = open_loop if args.rate else closed_loop
+        if args.warmup:
+            drive(args, port, Results(), time.perf_counter() + args.warmup)
+        results = Results()
+        start = time.perf_counter()
+        drive(args, port, results, start + args.duration)
+        elapsed = time.perf_counter() - start
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+        scratch.cleanup()
+
+    everything = results.latencies["GET"] + results.latencies["POST"]
+    report = {
+        "config": {
+            "mode": "open" if args.rate else "closed",
+            "clients": args.clients,
+            "rate": args.rate,
+            "duration": args.duration,
+            "post_ratio": args.post_ratio,
+            "keep_alive": args.keep_alive,
+            "gzip": args.gzip,
+            "entries": args.entries,
+        },
+        "elapsed": elapsed,
+        "errors": results.errors,
+        "bytes": results.bytes,
+        "all": summarize(everything, elapsed),
+        "get": summarize(results.latencies["GET"], elapsed),
+        "post": summarize(results.latencies["POST"], elapsed),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Startup-time benchmark. Each sample is a fresh interpreter, so nothing is
+# shared between runs but the OS file cache. Reports, as JSON:
+#
+#   import       time to `import browser`, with and without the parsed
+#                default stylesheet cache next to browser.py
+#   modules      the slowest modules browser.py imports, from -X importtime
+#   first_page   time from process start until the first page is painted,
+#                with the first fetch overlapping window creation (early) and
+#                after it (late), from a loopback server with --latency
+#
+#   python benchmarks/startup_bench.py --runs 10
+#   python benchmarks/startup_bench.py --latency 200 -o startup.json
+#
+# first_page needs a display and is reported as null without one.
+
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Prints the seconds `import browser` took in a fresh interpreter
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import browser
+print(time.perf_counter() - start)
+"""
+
+# Starts the browser on a URL and prints when the window was ready and when
+# the first page had a display list, counted from interpreter start
+FIRST_PAGE_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import browser
+url = browser.URL(sys.argv[1])
+if sys.argv[2] == "early":
+    browser.request_early(url)
+b = browser.Browser(prefetch=False)
+window = time.perf_counter() - start
+b.new_tab(url)
+def check():
+    if b.active_tab.display_list:
+        b.window.update()
+        print(json.dumps({"window_s": window, "painted_s": time.perf_counter() - start}))
+        b.window.destroy()
+    else:
+        b.window.after(1, check)
+check()
+b.window.mainloop()
+"""
+
+def run_python(args):
+    result = subprocess.run(
+        [sys.executable] + args, cwd=ROOT,
+        capture_output=True, text=True, timeout=60)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr else "failed")
+    return result
+
+def summarize(samples):
+    return {
+        "median_ms": statistics.median(samples) * 1000,
+        "min_ms": min(samples) * 1000,
+        "max_ms": max(samples) * 1000,
+    }
+
+def measure_import(runs, cached):
+    samples = []
+    for _ in range(runs):
+        if not cached and os.path.exists(os.path.join(ROOT, "browser.css.cache")):
+            os.remove(os.path.join(ROOT, "browser.css.cache"))
+        wall = time.perf_counter()
+        result = run_python(["-c", IMPORT_SCRIPT])
+        wall = time.perf_counter() - wall
+        samples.append((float(result.stdout), wall))
+    return {
+        "import": summarize([sample[0] for sample in samples]),
+        "process": summarize([sample[1] for sample in samples]),
+    }
+
+# The modules browser.py imports directly, slowest first, by their
+# cumulative import time in microseconds
+def slowest_modules(limit):
+    stderr = run_python(["-X", "importtime", "-c", "import browser"]).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit(): continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 1:
+            modules.append((name.strip(), int(cumulative)))
+    modules.sort(key=lambda module: -module[1])
+    return [{"module": name, "us": us} for name, us in modules[:limit]]
+
+def serve_page(latency):
+    body = ("<html><body>" + "<p>Startup benchmark page</p>" * 200 + "</body></html>").encode("utf-8")
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure_first_page(runs, latency):
+    server = serve_page(latency)
+    url = "http://127.0.0.1:{}/".format(server.server_address[1])
+    results = {}
+    try:
+        for mode in ["early", "late"]:
+            samples = [json.loads(run_python(["-c", FIRST_PAGE_SCRIPT, url, mode]).stdout)
+                       for _ in range(runs)]
+            results[mode] = {
+                "window": summarize([sample["window_s"] for sample in samples]),
+                "painted": summarize([sample["painted_s"] for sample in samples]),
+            }
+    finally:
+        server.shutdown()
+    return results
+
+def has_display():
+    try:
+        run_python(["-c", "import tkinter; tkinter.Tk().destroy()"])
+        return True
+    except RuntimeError:
+        return False
+
+def main():
+    parser = argparse.ArgumentParser(description="Startup-time benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="fresh interpreters per measurement")
+    parser.add_argument("--latency", type=float, default=100,
+                        help="milliseconds the first page takes to answer")
+    parser.add_argument("--modules", type=int, default=10, help="slowest imports to list")
+    parser.add_argument("-o", "--output", help="write the JSON results here")
+    args = parser.parse_args()
+
+    # Write bytecode (even under PYTHONDONTWRITEBYTECODE) and the stylesheet cache
+    run_python(["-m", "py_compile", "browser.py"])
+    run_python(["-c", "import browser"])
+    report = {
+        "python": sys.version.split()[0],
+        "import": {
+            "cached_stylesheet": measure_import(args.runs, cached=True),
+            "parsed_stylesheet": measure_import(args.runs, cached=False),
+        },
+        "modules": slowest_modules(args.modules),
+    }
+    if has_display():
+        report["first_page"] = measure_first_page(args.runs, args.latency / 1000)
+    else:
+        print("No display; skipping first_page", file=sys.stderr)
+        report["first_page"] = None
+    run_python(["-c", "import browser"])    # Leave the cache in place
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,134 @@
 import socket
-import ssl
+import selectors
+import errno
 import os
 import time
-import gzip
+import zlib
+import codecs
+import hashlib
 import tkinter
 import sys
 import tkinter.font
-import urllib.parse 
+import collections
+import threading
+import queue
+import re
+import mmap
+import struct
+import concurrent.futures
+import types
+import json
+import functools
+import tracemalloc
+import weakref
+import marshal
+# ssl, urllib.parse and multiprocessing are slow to import and only needed
+# for https, redirects, forms and --multiprocess, so they are imported where
+# they are used
+
+TRACE_BUFFER_SIZE = 1000000     # Most recent spans kept for export
+
+# Records timing spans for the Chrome trace-event format, so a session can
+# be inspected in chrome://tracing or Perfetto. Tracing is off unless the
+# browser is started with --trace; span() then hands out a shared no-op
+# context manager and traced functions cost one extra call.
+class Tracer:
+    def __init__(self, buffer_size=TRACE_BUFFER_SIZE):
+        self.enabled = False
+        self.events = collections.deque(maxlen=buffer_size)
+        self.threads = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def span(self, name, **args):
+        if not self.enabled: return NO_SPAN
+        return Span(self, name, args)
+
+    def record(self, name, start_ns, end_ns, args):
+        thread = threading.current_thread()
+        self.threads[thread.ident] = thread.name
+        event = {
+            "name": name, "cat": "browser", "ph": "X",
+            "ts": start_ns / 1000, "dur": (end_ns - start_ns) / 1000,
+            "pid": os.getpid(), "tid": thread.ident,
+        }
+        if args: event["args"] = args
+        self.events.append(event)
+
+    def export(self, path):
+        events = list(self.events)
+        for tid, name in list(self.threads.items()):
+            events.append({"name": "thread_name", "ph": "M", "pid": os.getpid(),
+                           "tid": tid, "args": {"name": name}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+class Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.record(self.name, self.start, time.perf_counter_ns(), self.args)
+
+class NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+NO_SPAN = NoSpan()
+TRACER = Tracer()
+
+# Wraps a function in a span. describe, if given, is called with the same
+# arguments to fill in the span's args, and only when tracing is on.
+def traced(name, describe=None):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not TRACER.enabled:
+                return function(*args, **kwargs)
+            span_args = describe(*args, **kwargs) if describe else {}
+            with TRACER.span(name, **span_args):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
 
 class URL:
     cache = {}
 
+    # Cache statistics, shared by all URLs
+    cache_hits = 0
+    cache_misses = 0
+    prefetched = set()      # Cache keys filled by the prefetcher and not used yet
+    prefetch_hits = 0
+    early = {}              # Cache key -> Future body from request_early
+
+    # ETags and bodies of recent responses, so they can be revalidated with
+    # If-None-Match once they expire (or if they were never cacheable)
+    validators = collections.OrderedDict()
+    validators_lock = threading.Lock()
+    revalidations = 0
+
+    # Name resolution and timeouts (in seconds) for new connections
+    resolver = None         # Set to a Resolver below
+    connect_timeout = 10
+    read_timeout = 30
+
     def __init__(self, url):
         if not is_valid_url(url):
             self.scheme = "about"
+            self.path = url[len("about:"):] if url.startswith("about:") else "blank"
+            self.content = None     # Body of generated pages such as about:memory
             return
         
         # Data scheme for inline HTML support
@@ -51,27 +166,51 @@ class URL:
 
         self.path = "/" + url
     
-    def request(self, payload=None, max_redirects=5):
+    # Returns the response body as a string, or as bytes if binary is set.
+    # on_data, if given, is called with each piece of the (decompressed)
+    # body as it arrives. Prefetched responses are kept for the next request
+    # even without a max-age, unless they are no-cache, and only used once.
+    @traced("URL.request", lambda self, *args, **kwargs:
+            {"url": str(self) if hasattr(self, "host") else self.scheme})
+    def request(self, payload=None, max_redirects=5, binary=False, on_data=None, prefetch=False):
         # Check if the url is malformed
         if self.scheme == "about":
-            return "about:blank"
+            return self.content or "about:blank"
         
-        # Check if the URL is cached and still valid
-        if self.scheme in ["http", "https"]:
-            cache_key = f"{self.scheme}://{self.host}{self.path}"
-        else:
-            cache_key = ''    
+        # Check if the URL is cached and still valid. Only GETs are cached.
+        cache_key = self.cache_key() if not payload else ''
+        early = URL.early.pop(cache_key, None) if cache_key and not prefetch else None
+        if early:
+            try:
+                content = early.result(self.read_timeout)
+            except concurrent.futures.TimeoutError:
+                content = None
+            if content is not None:
+                if on_data: on_data(content)
+                return content if binary else content.decode("utf-8", errors="replace")
         
-        if cache_key in self.cache:
-            content, expiration = self.cache[cache_key]
+        entry = self.cache.get(cache_key)
+        if entry:
+            content, expiration = entry
             if time.time() < expiration:
-                return content
+                URL.cache_hits += 1
+                # A prefetched response is only good for the navigation it
+                # was fetched for
+                if cache_key in URL.prefetched:
+                    URL.prefetched.discard(cache_key)
+                    self.cache.pop(cache_key, None)
+                    URL.prefetch_hits += 1
+                if on_data: on_data(content)
+                return content if binary else content.decode("utf-8", errors="replace")
+        if cache_key:
+            URL.cache_misses += 1
             
         if self.scheme == "file":
             if os.path.exists(self.file_path):
-                with open(self.file_path, 'r', encoding='utf-8') as file:
+                with open(self.file_path, 'rb') as file:
                     content = file.read()
-                return content
+                if on_data: on_data(content)
+                return content if binary else content.decode("utf-8")
             else:
                 raise FileNotFoundError(f"The file at {self.file_path} does not exist.")
         
@@ -81,39 +220,40 @@ class URL:
                 raise ValueError("Invalid data URL format.")
             content = self.html_content[comma_index + 1:]
             return content
-        
-        s = socket.socket(
-            family=socket.AF_INET,
-            type=socket.SOCK_STREAM,
-            proto=socket.IPPROTO_TCP,
-        )
-        
-        if self.scheme == "https":
-            ctx = ssl.create_default_context()
-            s = ctx.wrap_socket(s, server_hostname=self.host)
-        
-        s.connect((self.host, self.port))
 
         method = "POST" if payload else "GET"
-        request = "{} {} HTTP/1.0\r\n".format(method, self.path)
-        if payload:
-            length = len(payload.encode("utf-8"))
-            request += "Content-Length: {}\r\n".format(length)
-
-        request = f"GET {self.path} HTTP/1.1\r\n"
+        request = f"{method} {self.path} HTTP/1.1\r\n"
         request += f"Host: {self.host}\r\n"
         request += "Accept-Encoding: gzip\r\n"
-        #request += "Connection: close\r\n"
         request += "User-Agent: Martin\r\n"
+        with URL.validators_lock:
+            validator = URL.validators.get(cache_key)
+        if validator:
+            request += "If-None-Match: {}\r\n".format(validator[0])
+        if payload:
+            length = len(payload.encode("utf-8"))
+            request += "Content-Length: {}\r\n".format(length)
+            request += "Content-Type: application/x-www-form-urlencoded\r\n"
         request += "\r\n"
 
         if payload: request += payload
 
+        # Reuse an idle keep-alive connection to the same origin if there is one
+        origin = (self.scheme, self.host, self.port)
+        s = CONNECTIONS.take(origin)
+        reused = s is not None
+        if not reused:
+            s = self.connect()
+
         try:
-            s.send(request.encode("utf-8"))
+            s.sendall(request.encode("utf-8"))
 
-            response = s.makefile("rb", encoding="utf-8", newline="\r\n")
+            response = s.makefile("rb")
             statusline = response.readline().decode("utf-8")
+            if not statusline and reused:
+                # The server closed the idle connection; start over on a new one
+                s.close()
+                return self.request(payload, max_redirects, binary, on_data, prefetch)
             version, status, explanation = statusline.split(" ", 2)
 
             response_headers = {}
@@ -122,30 +262,60 @@ class URL:
                 if line == "\r\n": break
                 header, value = line.split(":", 1)
                 response_headers[header.casefold()] = value.strip()
-            
+
+            # Handle compression, decompressing as data arrives
+            content_encoding = response_headers.get("content-encoding", "")
+            if content_encoding == "gzip":
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            else:
+                decompressor = None
+            pieces = []
+            def receive(data):
+                if decompressor: data = decompressor.decompress(data)
+                pieces.append(data)
+                if on_data and data: on_data(data)
+
             # Check for Transfer-Encoding
             transfer_encoding = response_headers.get("transfer-encoding", "")
-            content = b""
             if transfer_encoding == "chunked":
                 while True:
                     chunk_size_line = response.readline().strip()
                     if not chunk_size_line:
                         break # No more chunks
-                    chunk_size = int(chunk_size_line, 16)
+                    chunk_size = int(chunk_size_line.split(b";")[0], 16)
                     if chunk_size == 0:
+                        # Skip any trailers up to the final empty line
+                        while response.readline().strip():
+                            pass
                         break # Last chunk
-                    chunk = response.read(chunk_size)
-                    content += chunk
+                    receive(response.read(chunk_size))
                     # Read the trailing CRLF after the chunk
                     response.readline()
             else:
-                content_length = int(response_headers.get("content-length", 0))
-                content = response.read(content_length)
-            
-            # Handle compression
-            content_encoding = response_headers.get("content-encoding", "")
-            if content_encoding == "gzip":
-                content = gzip.decompress(content).decode("utf-8")
+                remaining = int(response_headers.get("content-length", 0))
+                while remaining > 0:
+                    data = response.read(min(remaining, READ_CHUNK_SIZE))
+                    if not data: break
+                    remaining -= len(data)
+                    receive(data)
+            if decompressor:
+                tail = decompressor.flush()
+                pieces.append(tail)
+                if on_data and tail: on_data(tail)
+            content = b"".join(pieces)
+
+            # The whole response has been read, so the connection can be reused
+            framed = transfer_encoding == "chunked" or "content-length" in response_headers \
+                or status in ("204", "304")
+            if framed and response_headers.get("connection", "").lower() != "close":
+                CONNECTIONS.put(origin, s)
+            else:
+                s.close()
+
+            # Our copy is still current
+            if status == "304" and validator:
+                URL.revalidations += 1
+                content = validator[1]
 
             # Handle redirection logic
             if 300 <= int(status) <= 400:
@@ -154,23 +324,40 @@ class URL:
                 
                 new_url = response_headers.get("location")
                 if new_url:
-                    new_url = urllib.parse.urljoin(f"{self.scheme}://{self.host}", new_url)
+                    import urllib.parse
+                    new_url = urllib.parse.urljoin(str(self), new_url)
                     redirected_url = URL(new_url)
-                    return redirected_url.request(max_redirects=max_redirects-1)           
+                    return redirected_url.request(max_redirects=max_redirects-1, binary=binary,
+                                                  on_data=on_data, prefetch=prefetch)
 
             # Check the Cache-Control header for caching directives
-            cache_control = response_headers.get("cache_control", "").lower()
-            if "no-store" in cache_control:
+            cache_control = response_headers.get("cache-control", "").lower()
+            if not cache_key or "no-store" in cache_control:
                 # Do not cache this response
                 pass
             elif "max-age" in cache_control:
                 max_age = int(cache_control.split('max-age=')[-1].split(",")[0])
                 expiration = time.time() + max_age
                 self.cache[cache_key] = (content, expiration)
+            elif prefetch and status == "200" and "no-cache" not in cache_control:
+                self.cache[cache_key] = (content, time.time() + PREFETCH_TTL)
+                URL.prefetched.add(cache_key)
             else:
                 # Other cache-control derivatives: do not cache
                 pass
 
+            if cache_key and status == "200" and "etag" in response_headers \
+                    and "no-store" not in cache_control:
+                with URL.validators_lock:
+                    URL.validators[cache_key] = (response_headers["etag"], content)
+                    URL.validators.move_to_end(cache_key)
+                    if len(URL.validators) > VALIDATOR_CACHE_SIZE:
+                        URL.validators.popitem(last=False)
+
+            if binary:
+                return content
+            content = content.decode("utf-8", errors="replace")
+
             if self.view_source:
                 content = content.replace("<", "&lt;")
                 content = content.replace(">", "&gt;")
@@ -181,6 +368,38 @@ class URL:
             s.close()
             return None
 
+    # Key of this URL's responses in URL.cache and URL.validators, or '' if
+    # its responses are never cached
+    def cache_key(self):
+        if self.scheme in ["http", "https"]:
+            return f"{self.scheme}://{self.host}{self.path}"
+        return ''
+
+    def connect(self):
+        addresses = self.resolver.resolve(self.host, self.port, self.connect_timeout)
+        try:
+            s = connect_racing(addresses, self.connect_timeout)
+        except OSError:
+            # Maybe the addresses changed; look them up again next time
+            self.resolver.forget(self.host, self.port)
+            raise
+        s.settimeout(self.read_timeout)
+        
+        if self.scheme == "https":
+            import ssl
+            ctx = ssl.create_default_context()
+            s = ctx.wrap_socket(s, server_hostname=self.host)
+        
+        CONNECTIONS.opened += 1
+        return s
+
+    # Open a connection ahead of time, so a later request skips the
+    # DNS, TCP and TLS setup
+    def preconnect(self):
+        origin = (self.scheme, self.host, self.port)
+        if not CONNECTIONS.has_idle(origin):
+            CONNECTIONS.put(origin, self.connect())
+
     # Function that converts a relative url into a full url
     def resolve(self, url):
         if "://" in url: return URL(url)
@@ -197,6 +416,8 @@ class URL:
             return URL(self.scheme + "://" + self.host + ":" + str(self.port) + url)
 
     def __str__(self):
+        if self.scheme == "about":
+            return "about:" + self.path
         port_part = ":" + str(self.port)
         if self.scheme == "https" and self.port == 443:
             port_part = ""
@@ -204,12 +425,188 @@ class URL:
             port_part = ""
         return self.scheme + "://" + self.host + port_part + self.path
 
-def is_valid_url(url):
+READ_CHUNK_SIZE = 16 * 1024
+VALIDATOR_CACHE_SIZE = 256      # Responses kept for If-None-Match revalidation
+DNS_TTL = 60                    # Seconds to keep resolved addresses
+HAPPY_EYEBALLS_DELAY = 0.25     # Seconds before racing the next address
+
+# Caches getaddrinfo results for DNS_TTL seconds. getaddrinfo can be
+# replaced, e.g. by a stub that maps names to loopback addresses.
+# getaddrinfo itself has no timeout, so lookups run on their own daemon
+# threads and callers stop waiting after a timeout; a lookup that is still
+# running is shared by everyone asking for the same name.
+class Resolver:
+    def __init__(self, getaddrinfo=socket.getaddrinfo, ttl=DNS_TTL):
+        self.getaddrinfo = getaddrinfo
+        self.ttl = ttl
+        self.cache = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    # Returns [(family, sockaddr)], alternating IPv6 and IPv4 addresses
+    # starting with whichever family the system prefers
+    def resolve(self, host, port, timeout=None):
+        key = (host, port)
+        with self.lock:
+            if key in self.cache:
+                addresses, expiration = self.cache[key]
+                if time.monotonic() < expiration:
+                    return addresses
+            future = self.in_flight.get(key)
+            if not future:
+                future = concurrent.futures.Future()
+                self.in_flight[key] = future
+                threading.Thread(target=self.lookup, args=(key, future),
+                                 name="resolve", daemon=True).start()
+        try:
+            infos = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError(f"Timed out resolving {host}")
+        by_family = {}
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr) not in by_family.setdefault(family, []):
+                by_family[family].append((family, sockaddr))
+        addresses = []
+        families = list(by_family.values())
+        while any(families):
+            for group in families:
+                if group: addresses.append(group.pop(0))
+        if not addresses:
+            raise OSError(f"No addresses found for {host}")
+
+        with self.lock:
+            self.cache[key] = (addresses, time.monotonic() + self.ttl)
+        return addresses
+
+    def lookup(self, key, future):
+        try:
+            future.set_result(self.getaddrinfo(*key, type=socket.SOCK_STREAM))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+    def forget(self, host, port):
+        with self.lock:
+            self.cache.pop((host, port), None)
+
+IN_PROGRESS = [0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN,
+               getattr(errno, "WSAEWOULDBLOCK", None)]
+
+# Connect to the first of several addresses to answer ("happy eyeballs").
+# Attempts start HAPPY_EYEBALLS_DELAY apart, or immediately after the
+# previous one fails; the first to succeed wins and the rest are closed.
+def connect_racing(addresses, timeout, delay=HAPPY_EYEBALLS_DELAY):
+    remaining = list(addresses)
+    pending = {}
+    selector = selectors.DefaultSelector()
+    deadline = time.monotonic() + timeout
+    next_attempt = time.monotonic()
+    error = None
+    winner = None
+    try:
+        while remaining or pending:
+            now = time.monotonic()
+            if now >= deadline: break
+
+            if remaining and (now >= next_attempt or not pending):
+                family, address = remaining.pop(0)
+                s = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                s.setblocking(False)
+                err = s.connect_ex(address)
+                if err not in IN_PROGRESS:
+                    s.close()
+                    error = OSError(err, os.strerror(err))
+                    continue
+                selector.register(s, selectors.EVENT_WRITE)
+                pending[s] = address
+                next_attempt = now + delay
+
+            wait = (min(deadline, next_attempt) if remaining else deadline) - now
+            for key, _ in selector.select(max(wait, 0)):
+                s = key.fileobj
+                selector.unregister(s)
+                del pending[s]
+                err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = s
+                    winner.setblocking(True)
+                    return winner
+                s.close()
+                error = OSError(err, os.strerror(err))
+                next_attempt = time.monotonic()
+        raise error or TimeoutError("Timed out connecting to " + str(addresses[0][1]))
+    finally:
+        for s in pending:
+            s.close()
+        selector.close()
+
+
+KEEPALIVE_IDLE_SECONDS = 30     # Idle connections older than this are not reused
+MAX_IDLE_CONNECTIONS = 6        # Per origin
+
+# Idle keep-alive connections, keyed by (scheme, host, port)
+class ConnectionPool:
+    def __init__(self):
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+
+    def take(self, origin):
+        with self.lock:
+            connections = self.idle.get(origin, [])
+            while connections:
+                s, since = connections.pop()
+                if time.monotonic() - since < KEEPALIVE_IDLE_SECONDS:
+                    self.reused += 1
+                    return s
+                s.close()
+        return None
+
+    def put(self, origin, s):
+        with self.lock:
+            connections = self.idle.setdefault(origin, [])
+            if len(connections) >= MAX_IDLE_CONNECTIONS:
+                s.close()
+            else:
+                connections.append((s, time.monotonic()))
+
+    def has_idle(self, origin):
+        with self.lock:
+            return bool(self.idle.get(origin))
+
+CONNECTIONS = ConnectionPool()
+URL.resolver = Resolver()
+
+# Fetches a page on a worker thread, e.g. the first page while Tk starts
+# up. The next request for it waits for this one and takes its body instead
+# of sending its own; later requests go to the network (or the cache, if the
+# response allowed it) as usual.
+def request_early(url):
+    key = url.cache_key()
+    if not key: return
+    body = URL.early[key] = concurrent.futures.Future()
+    def fetch():
         try:
-            result = urllib.parse.urlparse(url)
-            return all([result.scheme, result.netloc]) or url == "about:blank"
-        except ValueError:
-            return False
+            content = url.request(prefetch=True, binary=True)
+        except Exception:
+            content = None
+        # A prefetch stays cached until it is used, but this body is handed
+        # over directly
+        if key in URL.prefetched:
+            URL.prefetched.discard(key)
+            URL.cache.pop(key, None)
+        body.set_result(content)
+    threading.Thread(target=fetch, daemon=True).start()
+
+# A scheme followed by "//" and a host, which is what urlparse finding both
+# a scheme and a netloc amounts to
+URL_WITH_HOST = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://[^/?#]")
+
+def is_valid_url(url):
+    return URL_WITH_HOST.match(url) is not None or url == "about:blank"
 
 def add_headers(request, headers: dict):
     assert "Host" in request
@@ -258,6 +655,7 @@ class Chrome:
         self.browser = browser
         self.font = get_font(15, "normal", "roman")
         self.font_height = self.font.metrics("linespace")
+        self.overlay_font = get_font(11, "normal", "roman")
         self.padding = 5
         self.tabbar_top = 0
         self.tabbar_bottom = self.font_height + 2*self.padding
@@ -266,6 +664,10 @@ class Chrome:
         self.bottom = self.urlbar_bottom
         self.focus = None
         self.address_bar = ""
+
+        # Cached display list and the state it was painted from
+        self.display_list = []
+        self.painted_state = None
         
         # New tab button 
         plus_width = self.font.measure("+") + 2*self.padding
@@ -291,13 +693,15 @@ class Chrome:
             WIDTH - self.padding,
             self.urlbar_bottom - self.padding
         )
+
+        # Tab geometry only depends on the font, so measure it once
+        self.tabs_start = self.newtab_rect.right + self.padding
+        self.tab_width = self.font.measure("Tab X") + 2*self.padding
     
     def tab_rect(self, i):
-        tabs_start = self.newtab_rect.right + self.padding
-        tab_width = self.font.measure("Tab X") + 2*self.padding
         return Rect(
-            tabs_start + tab_width * i, self.tabbar_top,
-            tabs_start + tab_width * (i+1), self.tabbar_bottom
+            self.tabs_start + self.tab_width * i, self.tabbar_top,
+            self.tabs_start + self.tab_width * (i+1), self.tabbar_bottom
         )
     
     def blur(self):
@@ -315,7 +719,7 @@ class Chrome:
         else:
             for i, tab in enumerate(self.browser.tabs):
                 if self.tab_rect(i).containsPoint(x, y):
-                    self.browser.active_tab = tab
+                    self.browser.set_active_tab(tab)
                     break
     
     def keypress(self, char):
@@ -333,6 +737,28 @@ class Chrome:
         if self.focus == "address bar" and len(self.address_bar) > 0:
             self.address_bar = self.address_bar[:-1]  # Create a new string by cutting the last letter of the old one
 
+    # Everything the chrome's appearance depends on. The cached display list
+    # is only rebuilt when this changes.
+    def state(self):
+        tabs = self.browser.tabs
+        active = self.browser.active_tab
+        active_index = tabs.index(active) if active in tabs else None
+        url = str(active.url) if active else ""
+        return (len(tabs), active_index, self.focus, self.address_bar, url, WIDTH,
+                self.browser.overlay.lines)
+
+    # Draw the chrome onto its own "chrome" tagged canvas items. Content
+    # redraws (e.g. scrolling) leave these items alone; content is created
+    # below them, so they stay on top without being restacked.
+    def draw(self, canvas):
+        state = self.state()
+        if state != self.painted_state:
+            self.display_list = self.paint()
+            self.painted_state = state
+            canvas.delete("chrome")
+            for cmd in self.display_list:
+                cmd.execute(0, canvas, "chrome")
+
     def paint(self):
         cmds = []
 
@@ -413,11 +839,29 @@ class Chrome:
                 self.address_rect.top,
                 url, self.font, "black"
         ))
+
+        # Performance overlay, in the top right corner of the page
+        lines = self.browser.overlay.lines
+        if lines:
+            line_height = self.overlay_font.metrics("linespace")
+            width = max(self.overlay_font.measure(line) for line in lines) + 2*self.padding
+            box = Rect(
+                WIDTH - width - self.padding, self.bottom + self.padding,
+                WIDTH - self.padding,
+                self.bottom + self.padding + line_height * len(lines) + 2*self.padding
+            )
+            cmds.append(DrawRect(box, "lightyellow"))
+            cmds.append(DrawOutline(box, "gray", 1))
+            for i, line in enumerate(lines):
+                cmds.append(DrawText(
+                    box.left + self.padding, box.top + self.padding + line_height * i,
+                    line, self.overlay_font, "black"
+                ))
             
         return cmds
 
 class Browser:
-    def __init__(self):
+    def __init__(self, multiprocess=False, prefetch=True):
         self.tabs = []
         self.active_tab = None        
         self.window = tkinter.Tk()
@@ -428,7 +872,22 @@ class Browser:
             bg="white",
         )
         self.url = None
+        self.focus = None
         self.chrome = Chrome(self)
+        self.scheduler = FrameScheduler(self.window, self.render_frame)
+        self.overlay = PerfOverlay(self)
+
+        # Pages load on worker threads and are handed back through this queue
+        self.commit_queue = queue.Queue()
+        self.window.after(COMMIT_POLL_MS, self.poll_commits)
+
+        # Drops the layout and DOM of tabs that are not visible
+        self.lifecycle = TabLifecycle()
+
+        # Warms up connections and the cache for links on screen once the
+        # browser has been idle for a moment
+        self.prefetcher = Prefetcher(prefetch)
+        self.prefetch_timer = None
 
         self.canvas.pack(fill="both", expand=True)
         self.window.bind("<Configure>", self.on_resize)
@@ -452,34 +911,65 @@ class Browser:
         self.window.bind("<Return>", self.handle_enter)
         self.window.bind("<BackSpace>", self.handle_backspace)
         self.window.bind("<Button-2>", self.handle_click)
+        self.window.bind("<Control-w>", self.handle_close_tab)
+        self.window.bind("<F12>", self.handle_toggle_overlay)
+
+        # In multi-process mode every tab runs its page in a renderer process
+        self.tab_class = RendererTab if multiprocess else Tab
 
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
+        new_tab = self.tab_class(HEIGHT - self.chrome.bottom, self.commit_queue)
         new_tab.load(url)
-        self.active_tab = new_tab
         self.tabs.append(new_tab)
-        self.draw()
+        self.set_active_tab(new_tab)
+
+    def set_active_tab(self, tab):
+        previous = self.active_tab
+        self.active_tab = tab
+        self.lifecycle.activate(tab, previous if previous in self.tabs else None)
+        self.scheduler.schedule()
+
+    def close_tab(self, tab):
+        index = self.tabs.index(tab)
+        self.tabs.remove(tab)
+        self.lifecycle.remove(tab)
+        tab.close()
+        if not self.tabs:
+            self.window.destroy()
+            return
+        if tab == self.active_tab:
+            self.set_active_tab(self.tabs[min(index, len(self.tabs) - 1)])
+        self.scheduler.schedule()
+
+    def handle_close_tab(self, e):
+        self.close_tab(self.active_tab)
+
+    def handle_toggle_overlay(self, e):
+        self.overlay.toggle()
 
     def handle_down(self, e):
         self.active_tab.scrolldown()
-        self.draw()
+        self.scheduler.schedule()
     
     def handle_up(self, e):
         self.active_tab.scrollup()
-        self.draw()
+        self.scheduler.schedule()
     
     def handle_mouse_scroll(self, e):
         self.active_tab.on_mouse_scroll(e)
-        self.draw()
+        self.scheduler.schedule()
+
+    def handle_mouse_scroll_linux(self, e):
+        self.active_tab.on_mouse_scroll_linux(e)
+        self.scheduler.schedule()
     
     def on_resize(self, e):
         global WIDTH, HEIGHT
         WIDTH, HEIGHT = e.width, e.height
-        self.active_tab.document = DocumentLayout(self.active_tab.nodes)
-        self.active_tab.document.layout()
-        self.active_tab.display_list = []
-        paint_tree(self.active_tab.document, self.active_tab.display_list)
-        self.draw()
+        # Background tabs are only laid out again once they are activated
+        for tab in self.tabs:
+            tab.needs_layout = True
+        self.scheduler.schedule()
 
     def handle_click(self, e):
         if e.y < self.chrome.bottom:
@@ -492,50 +982,493 @@ class Browser:
             if e.num == 1:    # Left click
                 self.active_tab.click(e.x, tab_y, mid_click=False)
             elif e.num == 2:  # Middle click
-                self.new_tab(self.active_tab.click(e.x, tab_y, mid_click=True)) 
-        self.draw()
+                url = self.active_tab.click(e.x, tab_y, mid_click=True)
+                if url: self.new_tab(url)
+        self.scheduler.schedule()
     
     def handle_key(self, e):
         if len(e.char) == 0: return
         if not (0x20 <= ord(e.char) < 0x7f): return
         if self.chrome.keypress(e.char):
-            self.draw()
+            self.scheduler.schedule()
         elif self.focus == "content":
             self.active_tab.keypress(e.char)
-            self.draw()
+            self.scheduler.schedule()
     
     def handle_enter(self, e):
         self.chrome.enter()
-        self.draw()
+        self.scheduler.schedule()
 
     def handle_backspace(self, e):
         self.chrome.backspace()
+        self.scheduler.schedule()
+
+    # Run the results of background work on the main thread. Each entry is a
+    # tab method (such as Tab.commit) that returns True if the tab changed;
+    # stale results are dropped by the method itself.
+    def poll_commits(self):
+        while True:
+            try:
+                tab, method, args = self.commit_queue.get_nowait()
+            except queue.Empty:
+                break
+            if method(*args) and tab == self.active_tab:
+                self.scheduler.schedule()
+        self.window.after(COMMIT_POLL_MS, self.poll_commits)
+
+    # Runs once per frame: bring the active tab up to date, then draw
+    @traced("Browser.render_frame")
+    def render_frame(self):
+        self.active_tab.render()
         self.draw()
+
+        if self.prefetch_timer:
+            self.window.after_cancel(self.prefetch_timer)
+        self.prefetch_timer = self.window.after(PREFETCH_IDLE_MS, self.prefetch_links)
+
+    def prefetch_links(self):
+        self.prefetch_timer = None
+        self.prefetcher.run(self.active_tab)
     
     def draw(self):
-        self.canvas.delete("all")
         self.active_tab.draw(self.canvas, self.chrome.bottom)
-        for cmd in self.chrome.paint():
-            cmd.execute(0, self.canvas)
+        self.chrome.draw(self.canvas)
 
 WIDTH, HEIGHT = 800, 600
 HSTEP, VSTEP = 13, 18
 SCROLL_STEP = 100
 SCROLL_HEIGHT = 100
+REFRESH_RATE_MS = 16    # ~60 frames per second
+FRAME_HISTORY = 120     # Number of recent frame timings to keep
+COMMIT_POLL_MS = 10     # How often the main thread checks for finished loads
+OVERLAY_SAMPLE_MS = 500 # How often the performance overlay is refreshed
+
+TAB_MEMORY_BUDGET = 64 * 1024 * 1024    # Bytes for all open tabs together
+# Rough per-object sizes used to estimate a tab's memory use
+DOM_NODE_BYTES = 600
+LAYOUT_OBJECT_BYTES = 500
+DRAW_COMMAND_BYTES = 300
+
+PREFETCH_IDLE_MS = 500                  # Quiet time before prefetching starts
+PREFETCH_CONCURRENCY = 2
+PREFETCH_BYTES_PER_PAGE = 512 * 1024
+PREFETCH_TTL = 300                      # Seconds a prefetched page stays cached
+
+# Preconnects to the origins of links on screen and, if enabled, fetches
+# same-origin link targets into the HTTP cache, within a byte budget per page
+# and with at most PREFETCH_CONCURRENCY requests at a time. Links beyond that
+# wait in a queue and start as earlier fetches finish.
+class Prefetcher:
+    def __init__(self, prefetch=True):
+        self.prefetch = prefetch
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=PREFETCH_CONCURRENCY, thread_name_prefix="prefetch")
+        self.page = None
+        self.bytes = 0          # Spent on the current page
+        self.pending = 0
+        self.queue = collections.deque()    # Links of the current page waiting for a slot
+        self.fetched = set()    # URLs fetched or queued
+        self.preconnected = {}  # origin -> when it was last preconnected
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.preconnects = 0
+        self.prefetches = 0
+        self.prefetched_bytes = 0
+
+    def run(self, tab):
+        if tab.url is None: return
+        page = str(tab.url) if tab.url.scheme in ["http", "https"] else None
+        if page is None: return
+        if page != self.page:
+            self.page = page
+            with self.lock:
+                self.bytes = 0
+                # Links of the last page that never started may be wanted later
+                self.fetched.difference_update(str(url) for url in self.queue)
+                self.queue.clear()
+
+        now = time.monotonic()
+        links = []
+        for url in tab.visible_links():
+            if url.scheme not in ["http", "https"]: continue
+            # Pooled connections are dropped once they have been idle for
+            # KEEPALIVE_IDLE_SECONDS, after which the origin is worth another
+            origin = (url.scheme, url.host, url.port)
+            if now - self.preconnected.get(origin, -KEEPALIVE_IDLE_SECONDS) >= KEEPALIVE_IDLE_SECONDS:
+                self.preconnected[origin] = now
+                self.pool.submit(self.preconnect, url)
+
+            key = str(url)
+            same_origin = origin == (tab.url.scheme, tab.url.host, tab.url.port)
+            if not self.prefetch or not same_origin or key == page or key in self.fetched:
+                continue
+            self.fetched.add(key)
+            links.append(url)
+        with self.lock:
+            self.queue.extend(links)
+        self.start_next()
+
+    # Start queued fetches while there are free slots and budget left
+    def start_next(self):
+        while True:
+            with self.lock:
+                if not self.queue or self.pending >= PREFETCH_CONCURRENCY \
+                        or self.bytes >= PREFETCH_BYTES_PER_PAGE:
+                    return
+                url = self.queue.popleft()
+                self.pending += 1
+            self.pool.submit(self.fetch, url)
+
+    def preconnect(self, url):
+        try:
+            url.preconnect()
+            with self.lock:
+                self.preconnects += 1
+        except OSError:
+            pass
+
+    def fetch(self, url):
+        try:
+            body = url.request(prefetch=True, binary=True)
+            with self.lock:
+                self.bytes += len(body or b"")
+                self.prefetched_bytes += len(body or b"")
+                self.prefetches += 1
+        except Exception:
+            pass
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.start_next()
+
+    def stats(self):
+        lookups = URL.cache_hits + URL.cache_misses
+        return {
+            "preconnects": self.preconnects,
+            "reused_connections": CONNECTIONS.reused,
+            "prefetches": self.prefetches,
+            "prefetched_bytes": self.prefetched_bytes,
+            "prefetch_hits": URL.prefetch_hits,
+            "prefetch_hit_rate": URL.prefetch_hits / self.prefetches if self.prefetches else 0,
+            "cache_hit_rate": URL.cache_hits / lookups if lookups else 0,
+        }
+
+# Decides which tabs keep their page in memory. A tab that goes into the
+# background drops its layout tree and display list straight away. If the
+# open tabs are still over budget, the least recently used background tabs
+# also drop their DOM and only keep URL, history and scroll position.
+# Discarded state is rebuilt when the tab is activated again.
+class TabLifecycle:
+    def __init__(self, budget=TAB_MEMORY_BUDGET):
+        self.budget = budget
+        self.last_active = {}   # background tab -> when it was last shown
+
+    def activate(self, tab, previous):
+        if previous and previous is not tab:
+            self.last_active[previous] = time.monotonic()
+            previous.discard_layout()
+        self.last_active.pop(tab, None)
+        tab.restore()
+        self.enforce_budget(tab)
+
+    def remove(self, tab):
+        self.last_active.pop(tab, None)
+
+    def enforce_budget(self, active):
+        background = sorted(self.last_active, key=self.last_active.get)
+        sizes = {tab: tab.memory_estimate() for tab in background}
+        total = active.memory_estimate() + sum(sizes.values())
+        for tab in background:
+            if total <= self.budget: break
+            total -= sizes[tab]
+            tab.discard_dom()
+
+# Coalesces redraw requests so that any number of input events between two
+# frames results in a single render/draw, started no faster than the target rate
+class FrameScheduler:
+    def __init__(self, window, callback, interval_ms=REFRESH_RATE_MS):
+        self.window = window
+        self.callback = callback
+        self.interval = interval_ms / 1000
+        self.pending = False
+        self.last_frame_start = 0
+
+        # Statistics
+        self.requests = 0
+        self.frames = 0
+        self.dropped_frames = 0
+        self.frame_times = collections.deque(maxlen=FRAME_HISTORY)
+
+    # Mark the browser dirty; the frame runs on the next tick of the event loop
+    def schedule(self):
+        self.requests += 1
+        if self.pending: return
+        self.pending = True
+        elapsed = time.perf_counter() - self.last_frame_start
+        delay = max(0, self.interval - elapsed)
+        self.window.after(int(delay * 1000), self.run_frame)
+
+    def run_frame(self):
+        self.pending = False
+        start = time.perf_counter()
+        self.callback()
+        duration = time.perf_counter() - start
+
+        self.last_frame_start = start
+        self.frames += 1
+        self.frame_times.append(duration)
+        # A frame that overran its budget hid the frames it overlapped
+        if duration > self.interval:
+            self.dropped_frames += int(duration // self.interval)
+
+    def stats(self):
+        times = self.frame_times
+        return {
+            "frames": self.frames,
+            "dropped_frames": self.dropped_frames,
+            "coalesced_events": self.requests - self.frames,
+            "last_frame_ms": times[-1] * 1000 if times else 0,
+            "avg_frame_ms": sum(times) / len(times) * 1000 if times else 0,
+            "max_frame_ms": max(times) * 1000 if times else 0,
+        }
+
+# Resident set size of this process in bytes, or None where it can't be read
+def process_rss():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is the peak, in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+# Live performance numbers drawn over the page by Chrome.paint, toggled with
+# F12. Everything is read from counters the browser keeps anyway, on a timer
+# that only runs while the overlay is shown, so frames pay nothing for it.
+class PerfOverlay:
+    def __init__(self, browser):
+        self.browser = browser
+        self.visible = False
+        self.lines = ()
+        self.timer = None
+        # Node counts are cached per tree, since walking a big DOM every
+        # sample would show up in the frame times being measured
+        self.counted = {}   # "dom"/"layout" -> (tree, count)
+
+    def toggle(self):
+        self.visible = not self.visible
+        if self.visible:
+            self.sample()
+        else:
+            self.stop()
+            self.lines = ()
+            self.counted.clear()
+        self.browser.scheduler.schedule()
+
+    def stop(self):
+        if self.timer:
+            self.browser.window.after_cancel(self.timer)
+            self.timer = None
+
+    def sample(self):
+        self.timer = self.browser.window.after(OVERLAY_SAMPLE_MS, self.sample)
+        lines = self.collect()
+        if lines != self.lines:
+            self.lines = lines
+            self.browser.scheduler.schedule()
+
+    def count(self, kind, tree):
+        if not tree: return None
+        cached = self.counted.get(kind)
+        if cached and cached[0] is tree:
+            return cached[1]
+        count = sum(1 for _ in walk_tree(tree))
+        self.counted[kind] = (tree, count)
+        return count
+
+    def collect(self):
+        tab = self.browser.active_tab
+        if tab is None: return ()
+        frames = self.browser.scheduler.stats()
+        lookups = URL.cache_hits + URL.cache_misses
+        rss = process_rss()
+
+        def stages(timings, names):
+            return "  ".join("{} {}".format(name, "{:.1f}".format(timings[name] * 1000)
+                                            if name in timings else "-")
+                             for name in names)
+        def number(value):
+            return "-" if value is None else str(value)
+
+        return (
+            "frame {:.1f} ms  avg {:.1f}  max {:.1f}  dropped {}".format(
+                frames["last_frame_ms"], frames["avg_frame_ms"],
+                frames["max_frame_ms"], frames["dropped_frames"]),
+            "load (ms): " + stages(tab.load_timings, ["request", "parse", "css", "style"]),
+            "render (ms): " + stages(tab.render_timings, ["layout", "paint"]),
+            "display list {}  canvas items {}".format(
+                len(tab.display_list), len(self.browser.canvas.find_all())),
+            "DOM nodes {}  layout objects {}".format(
+                number(self.count("dom", tab.nodes)),
+                number(self.count("layout", tab.document))),
+            "URL cache {:.0f}% of {} lookups".format(
+                URL.cache_hits / lookups * 100 if lookups else 0, lookups),
+            "RSS {}".format("-" if rss is None else "{:.1f} MB".format(rss / 1024 / 1024)),
+        )
+
+# Approximate size of an object: the instance, its attribute dictionary and
+# any strings, bytes and containers it holds directly. Other objects it
+# points to (parents, fonts, nodes) are counted where they are owned.
+def object_bytes(obj, skip=()):
+    size = sys.getsizeof(obj)
+    attributes = getattr(obj, "__dict__", None)
+    if attributes is None: return size
+    size += sys.getsizeof(attributes)
+    for name, value in attributes.items():
+        if name in skip: continue
+        if isinstance(value, (str, bytes, list, tuple, dict)):
+            size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            size += sum(sys.getsizeof(key) + sys.getsizeof(item)
+                        for key, item in value.items())
+    return size
+
+# Bytes of cached response bodies (fresh and revalidatable) for these URLs.
+# A body held by both caches is only counted once.
+def response_bytes(urls):
+    bodies = {}
+    keys = {url.cache_key() for url in urls} - {''}
+    for key in keys:
+        if key in URL.cache:
+            body = URL.cache[key][0]
+            bodies[id(body)] = len(body)
+        with URL.validators_lock:
+            validator = URL.validators.get(key)
+        if validator:
+            bodies[id(validator[1])] = len(validator[1])
+    return sum(bodies.values())
+
+TRACEMALLOC_FRAMES = 10     # Stack depth recorded for each allocation
+MEMORY_DIFF_LINES = 20      # Allocation sites kept per navigation diff
+
+# Per-tab memory accounting, shown at about:memory. Tabs register themselves
+# when they are created. With tracing on, every navigation also records
+# which allocation sites grew between the start of the load and its commit,
+# which is where leaks show up. Everything here reads pages owned by the
+# main thread, so it must be called from the main thread.
+class MemoryAccounting:
+    def __init__(self):
+        self.tabs = weakref.WeakSet()
+        self.serves_pages = True    # False in renderers, which only know their own tab
+        self.snapshots = {}     # tab -> tracemalloc snapshot taken when its load started
+        self.diffs = weakref.WeakKeyDictionary()    # tab -> [StatisticDiff] of its last navigation
+
+    def track(self, tab):
+        self.tabs.add(tab)
+
+    def forget(self, tab):
+        self.tabs.discard(tab)
+        self.snapshots.pop(tab, None)
+
+    def start_tracing(self, frames=TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+
+    def snapshot(self):
+        # Leave out the snapshots' own bookkeeping
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+        ))
+
+    # Allocation sites that grew the most between two snapshots
+    def diff(self, before, after, limit=MEMORY_DIFF_LINES):
+        stats = after.compare_to(before, "lineno")
+        return [stat for stat in stats if stat.size_diff > 0][:limit]
+
+    def navigation_started(self, tab):
+        if tracemalloc.is_tracing():
+            self.snapshots[tab] = self.snapshot()
+
+    def navigation_committed(self, tab):
+        before = self.snapshots.pop(tab, None)
+        if before is not None and tracemalloc.is_tracing():
+            self.diffs[tab] = self.diff(before, self.snapshot())
+
+    # [(tab, usage)] for every open tab, where usage is Tab.memory_usage()
+    def report(self):
+        return [(tab, tab.memory_usage()) for tab in list(self.tabs)]
+
+    def page(self):
+        def kb(value):
+            return "-" if value is None else "{:.1f} KB".format(value / 1024)
+        out = ["<html><body><h1>Memory</h1>"]
+        rss = process_rss()
+        out.append("<p>Process RSS: {}</p>".format(
+            "-" if rss is None else "{:.1f} MB".format(rss / 1024 / 1024)))
+        # Biggest tabs first
+        report = sorted(self.report(), key=lambda entry: -entry[1]["total"])
+        for tab, usage in report:
+            out.append("<h2>{}</h2>".format(escape_html(usage["url"] or "New tab")))
+            for category in MEMORY_CATEGORIES:
+                out.append("<p>{}: {}</p>".format(category, kb(usage[category])))
+            out.append("<p><b>total: {}</b></p>".format(kb(usage["total"])))
+            for stat in self.diffs.get(tab, []):
+                frame = stat.traceback[0]
+                out.append("<p><code>+{} in {} new blocks at {}:{}</code></p>".format(
+                    kb(stat.size_diff), stat.count_diff,
+                    escape_html(os.path.basename(frame.filename)), frame.lineno))
+        if not tracemalloc.is_tracing():
+            out.append("<p>Start with --tracemalloc to see what each navigation allocated.</p>")
+        out.append("</body></html>")
+        return "\n".join(out)
+
+MEMORY_CATEGORIES = ["dom", "styles", "layout", "display_list", "responses", "renderer"]
+MEMORY = MemoryAccounting()
+
+def escape_html(text):
+    return text.replace("<", "&lt;").replace(">", "&gt;")
 
 class Tab:  
-    def __init__(self, tab_height):
+    def __init__(self, tab_height, commit_queue):
         self.url = None
         self.display_list = []
         self.nodes = []
+        self.document = None
         self.scroll = 0
         self.tab_height = tab_height
         self.history = []
         self.focus = None
+        self.needs_layout = False
+        self.dom_nodes = 0
+        # Counted when memory is next estimated, not on every render
+        self.layout_objects = None
+
+        # Seconds spent in each stage of the last load and render, for the
+        # performance overlay
+        self.load_timings = {}
+        self.render_timings = {}
+
+        # Background loading; load_id identifies the latest navigation
+        self.commit_queue = commit_queue
+        self.load_id = 0
+
+        # Set when the DOM was dropped to save memory
+        self.discarded = False
+        self.restore_scroll = 0
+        MEMORY.track(self)
 
     def draw_scrollbar(self, canvas, tab_offset):
-        # Get last element of display list to get the content height
-        y = self.display_list[-1].bottom
+        if not self.display_list: return
+
+        # Get last element of display list to get the content height. Only
+        # its rect is common to every kind of draw command.
+        y = self.display_list[-1].rect.bottom
 
         # If the whole content fits onscreen
         if y < HEIGHT:
@@ -552,32 +1485,43 @@ class Tab:
         scroll_fraction = self.scroll / (content_height - viewport_height)
         thumb_position = scroll_fraction * (viewport_height - thumb_size)
 
-        canvas.create_rectangle(WIDTH - 5, thumb_position + tab_offset, WIDTH, thumb_position + thumb_size + tab_offset, fill='blue')
+        canvas.create_rectangle(WIDTH - 5, thumb_position + tab_offset, WIDTH, thumb_position + thumb_size + tab_offset, fill='blue', tags="content")
 
+    # Lay out and paint again if the page changed since the last render.
+    # Styles are computed with the page load, off the main thread.
     def render(self):
-        style(self.nodes, sorted(self.rules, key=cascade_priority))
-        self.document = DocumentLayout(self.nodes)
-        self.document.layout()
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        if self.needs_layout and self.nodes:
+            start = time.perf_counter()
+            self.document = DocumentLayout(self.nodes)
+            self.document.layout()
+            self.layout_objects = None
+            layout_done = time.perf_counter()
+            self.display_list = []
+            paint_tree(self.document, self.display_list)
+            self.render_timings["layout"] = layout_done - start
+            self.render_timings["paint"] = time.perf_counter() - layout_done
+            self.needs_layout = False
 
     def keypress(self, char):
         if self.focus:
             self.focus.attributes["value"] += char
-            self.render()
+            self.needs_layout = True
 
     def click(self, x, y, mid_click=False):
         self.focus = None
+        if not self.document: return
 
         # Account for scrolling
         y += self.scroll
 
-        objs = [obj for obj in tree_to_list(self.document, [])
-                if obj.x <= x < obj.x + obj.width
-                and obj.y <= y < obj.y + obj.height]
-        if not objs: return
+        # The innermost box under the click comes last in pre-order
+        hit = None
+        for obj in walk_tree(self.document):
+            if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height:
+                hit = obj
+        if not hit: return
         
-        elt = objs[-1].node
+        elt = hit.node
         while elt:
             if isinstance(elt, Text):
                 pass
@@ -593,19 +1537,23 @@ class Tab:
                     self.focus.is_focused = False
                 self.focus = elt
                 elt.is_focused = True
-                return self.redner()
+                self.needs_layout = True
+                return
             elif elt.tag == "button":
                 while elt:
                     if elt.tag == "form" and "action" in elt.attributes:
                         return self.submit_form(elt)
+                    elt = elt.parent
+                return
             elt = elt.parent
 
     def submit_form(self, elt):
-        inputs = [node for node in tree_to_list(elt, []) 
+        inputs = (node for node in walk_tree(elt)
                   if isinstance(node, Element) 
                   and node.tag == "input"
-                  and "name" in node.attributes]
+                  and "name" in node.attributes)
         
+        import urllib.parse
         body = ""
         for input in inputs:
             name = input.attributes["name"]
@@ -630,7 +1578,14 @@ class Tab:
         elif e.num == 5:
             self.scrolldown()
 
+    # Links whose boxes are at least partly on screen
+    def visible_links(self):
+        if not self.document: return []
+        return [url for left, top, right, bottom, url in link_map(self)
+                if bottom > self.scroll and top < self.scroll + self.tab_height]
+
     def scrolldown(self):
+        if not self.document: return
         max_y = max(self.document.height + 2*VSTEP - self.tab_height, 0)
         self.scroll = min(self.scroll + SCROLL_HEIGHT, max_y)
                     
@@ -638,13 +1593,101 @@ class Tab:
         if self.scroll != 0:
             self.scroll -= SCROLL_STEP
 
+    @traced("Tab.draw")
     def draw(self, canvas, offset):
-        canvas.delete("all")
+        canvas.delete("content")
         self.draw_scrollbar(canvas, offset)
+        onscreen_images = set()
         for cmd in self.display_list:
             if cmd.rect.top > self.scroll + self.tab_height: continue
             if cmd.rect.bottom < self.scroll: continue
-            cmd.execute(self.scroll - offset, canvas)
+            if isinstance(cmd, DrawImage):
+                onscreen_images.add(cmd.url)
+                if IMAGE_CACHE.take_evicted(cmd.url):
+                    self.request_image(cmd.url)
+            cmd.execute(self.scroll - offset, canvas, "content")
+        # Evicting an image blanks the canvas items showing it
+        IMAGE_CACHE.pinned = onscreen_images
+        # Every content item was just created, so this only moves new items
+        # under the chrome
+        canvas.tag_lower("content")
+
+    # Drop whatever load is still in flight
+    def close(self):
+        self.load_id += 1
+        MEMORY.forget(self)
+
+    # Uses the node count taken when the page was loaded and a layout count
+    # kept until the next layout, since this runs on every tab switch
+    def memory_estimate(self):
+        if self.discarded or not self.nodes: return 0
+        estimate = self.dom_nodes * DOM_NODE_BYTES
+        if self.document:
+            if self.layout_objects is None:
+                self.layout_objects = sum(1 for _ in walk_tree(self.document))
+            estimate += self.layout_objects * LAYOUT_OBJECT_BYTES
+        estimate += len(self.display_list) * DRAW_COMMAND_BYTES
+        return estimate
+
+    # Approximate bytes held by each part of the page, by MEMORY_CATEGORIES.
+    # Slower but closer than memory_estimate, so it is only used on request.
+    def memory_usage(self):
+        nodes = list(walk_tree(self.nodes)) if self.nodes else []
+        styles = 0
+        for node in nodes:
+            style = getattr(node, "style", None)
+            if style is None: continue
+            styles += sys.getsizeof(style) + sum(
+                sys.getsizeof(name) + sys.getsizeof(value) for name, value in style.items())
+
+        # The page and the stylesheets and images it references
+        urls = [self.url] if self.url else []
+        for node in nodes:
+            if not isinstance(node, Element): continue
+            try:
+                if node.tag == "link" and node.attributes.get("rel") == "stylesheet" \
+                        and "href" in node.attributes:
+                    urls.append(self.url.resolve(node.attributes["href"]))
+                elif getattr(node, "image_url", None):
+                    urls.append(URL(node.image_url))
+            except Exception:
+                continue
+
+        usage = {
+            "url": str(self.url) if self.url else "",
+            "dom": sum(object_bytes(node, skip=("style",)) for node in nodes),
+            "styles": styles,
+            "layout": sum(object_bytes(obj) for obj in walk_tree(self.document))
+                      if self.document else 0,
+            "display_list": sum(object_bytes(cmd) + object_bytes(cmd.rect)
+                                for cmd in self.display_list),
+            "responses": response_bytes(urls),
+            "renderer": None,
+        }
+        usage["total"] = sum(usage[category] or 0 for category in MEMORY_CATEGORIES)
+        return usage
+
+    # Layout is rebuilt by the next render
+    def discard_layout(self):
+        self.document = None
+        self.display_list = []
+        self.needs_layout = True
+
+    def discard_dom(self):
+        # A load still in flight would bring the DOM back behind our back
+        self.load_id += 1
+        self.discard_layout()
+        self.nodes = []
+        self.rules = None
+        self.focus = None
+        self.discarded = True
+
+    # Reload a discarded tab, without adding a history entry
+    def restore(self):
+        if not self.discarded: return
+        self.discarded = False
+        self.restore_scroll = self.scroll
+        self.start_load(self.url, None)
 
     def go_back(self):
         if len(self.history) > 1:
@@ -652,37 +1695,480 @@ class Tab:
             back = self.history.pop()
             self.load(back)
 
+    # Start loading a page on a worker thread. The current page stays on
+    # screen until the new one is committed.
     def load(self, url, payload=None):
-        # Get website body
         self.history.append(url)
         self.url = url
-        body = url.request(payload)
-        if body == "about:blank":
-            self.canvas = tkinter.Canvas(self.window, width=WIDTH, height=HEIGHT, bg="white")
-            self.canvas.pack(fill=tkinter.BOTH, expand=True)
+        self.restore_scroll = 0
+        # Generated here, since the page describes every tab. Renderers get
+        # the page along with the URL.
+        if url.scheme == "about" and url.path == "memory" and MEMORY.serves_pages:
+            url.content = MEMORY.page()
+        MEMORY.navigation_started(self)
+        self.start_load(url, payload)
+
+    def start_load(self, url, payload):
+        # Starting a navigation supersedes any load still in flight
+        self.load_id += 1
+        threading.Thread(
+            target=self.load_in_background,
+            args=(url, payload, self.load_id),
+            daemon=True
+        ).start()
+
+    def load_in_background(self, url, payload, load_id):
+        cancelled = lambda: self.load_id != load_id
+        try:
+            result = self.fetch_document(url, payload, cancelled)
+        except Exception as e:
+            print(f"Failed to load {url}: {e}")
+            return
+        if result is not None:
+            self.commit_queue.put((self, self.commit, (load_id, *result)))
+
+    # Fetch, parse and style a page. Does not touch Tk, so it is safe to run
+    # off the main thread. Returns None if the load was cancelled.
+    def fetch_document(self, url, payload=None, cancelled=lambda: False):
+        # Get website body, starting subresource fetches as tags stream in
+        timings = {}
+        start = time.perf_counter()
+        scanner = PreloadScanner(url)
+        body = url.request(payload, on_data=scanner.feed)
+        if body is None or body == "about:blank":
+            body = ""
+        if cancelled(): return None
+        timings["request"] = time.perf_counter() - start
         
         # Parse html tree
-        self.nodes = HTMLParser(body).parse()
+        start = time.perf_counter()
+        nodes = HTMLParser(body).parse()
+        timings["parse"] = time.perf_counter() - start
         
         # Apply styles
-        self.rules = DEFAULT_STYLE_SHEET.copy()
+        sheets = []
         links = [node.attributes["href"]
-                 for node in tree_to_list(self.nodes, [])
+                 for node in walk_tree(nodes)
                  if isinstance(node, Element)
                  and node.tag == "link"
                  and node.attributes.get("rel") == "stylesheet"
                  and "href" in node.attributes]
-        for link in links:
-            style_url = url.resolve(link)
+        start = time.perf_counter()
+        with TRACER.span("Tab.load stylesheets", count=len(links)):
+            for link in links:
+                if cancelled(): return None
+                style_url = url.resolve(link)
+                try:
+                    if str(style_url) in scanner.stylesheets:
+                        sheets.append(scanner.stylesheets[str(style_url)].result())
+                    else:
+                        sheets.append(fetch_stylesheet(style_url))
+                except:
+                    continue
+            rules = STYLESHEETS.cascade(sheets)
+        timings["css"] = time.perf_counter() - start
+
+        # Resolve image URLs now so they can be fetched as soon as the page
+        # commits, and count the nodes for the tab's memory estimate
+        images = []
+        dom_nodes = 0
+        for node in walk_tree(nodes):
+            dom_nodes += 1
+            if isinstance(node, Element) and node.tag == "img" and "src" in node.attributes:
+                node.image_url = str(url.resolve(node.attributes["src"]))
+                images.append(node.image_url)
+
+        start = time.perf_counter()
+        style(nodes, rules)
+        timings["style"] = time.perf_counter() - start
+        if cancelled(): return None
+        self.load_timings = timings
+        return nodes, rules, images, dom_nodes
+
+    # Install a loaded page on the main thread. Layout happens here, since
+    # it measures text with Tk fonts. Returns False for superseded loads.
+    def commit(self, load_id, nodes, rules, images, dom_nodes):
+        if load_id != self.load_id: return False
+        self.nodes = nodes
+        self.dom_nodes = dom_nodes
+        self.rules = rules
+        self.focus = None
+        self.scroll = self.restore_scroll
+        self.needs_layout = True
+        for image_url in images:
+            self.request_image(image_url)
+        MEMORY.navigation_committed(self)
+        return True
+
+    # Images are fetched on the image pool and decoded once they are back on
+    # the main thread; the page is usable while they load
+    def request_image(self, image_url):
+        if IMAGE_CACHE.get(image_url): return
+        load_id = self.load_id
+        def done(future):
+            if future.exception():
+                print(f"Failed to load image {image_url}: {future.exception()}")
+                return
+            self.commit_queue.put((self, self.image_loaded, (load_id, image_url, future.result())))
+        IMAGE_LOADER.fetch(image_url).add_done_callback(done)
+
+    def image_loaded(self, load_id, image_url, data):
+        image = IMAGE_CACHE.decode(image_url, data)
+        if not image or load_id != self.load_id or not self.document: return False
+
+        # Only the lines holding this image are laid out again
+        lines = [obj.parent for obj in walk_tree(self.document)
+                 if isinstance(obj, ImageLayout) and obj.url == image_url]
+        for line in lines:
+            self.relayout_line(line)
+        self.display_list = []
+        paint_tree(self.document, self.display_list)
+        return True
+
+    # Lay out a single line again and move everything below it by however
+    # much its height changed
+    def relayout_line(self, line):
+        old_height = line.height
+        line.layout()
+        dy = line.height - old_height
+        if dy == 0: return
+
+        ancestor = line.parent
+        while ancestor:
+            ancestor.height += dy
+            ancestor = ancestor.parent
+
+        # The line's own words were placed by its layout, so skip them
+        below = False
+        for obj in walk_tree(self.document, prune=lambda obj: obj is line):
+            if obj is line:
+                below = True
+            elif below:
+                obj.y += dy
+
+# A tab whose page is loaded, styled, laid out and painted in a renderer
+# subprocess. The browser process only keeps the serialized display list
+# and rasterizes it; closing the tab ends the process and frees its memory.
+class RendererTab(Tab):
+    def __init__(self, tab_height, commit_queue):
+        super().__init__(tab_height, commit_queue)
+        self.height = 0
+        self.links = []
+        self.renderer_load_id = None
+        self.renderer_memory = 0
+        self.start_renderer()
+
+    def start_renderer(self):
+        import multiprocessing
+        context = multiprocessing.get_context("spawn")
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=renderer_main,
+            args=(child_connection, self.tab_height, WIDTH),
+            daemon=True
+        )
+        self.process.start()
+        child_connection.close()
+
+        # Forward frames from the renderer to the browser's commit queue
+        threading.Thread(target=self.receive_frames, daemon=True).start()
+
+    def send(self, *message):
+        try:
+            self.connection.send(message)
+        except OSError:
+            pass  # The renderer has exited
+
+    def receive_frames(self):
+        while True:
             try:
-                body = style_url.request()
-            except:
-                continue
-            self.rules.extend(CSSParser(body).parse())
+                message = self.connection.recv()
+            except (EOFError, OSError):
+                break
+            self.commit_queue.put((self, self.commit, (self.load_id, *message[1:])))
+
+    def start_load(self, url, payload):
+        self.send("load", url, payload)
+
+    def commit(self, load_id, url, renderer_load_id, height, display_list, links, memory):
+        if load_id != self.load_id: return False
+        # A new page from the renderer starts at the top
+        if renderer_load_id != self.renderer_load_id:
+            self.renderer_load_id = renderer_load_id
+            self.scroll = self.restore_scroll
+            self.restore_scroll = 0
+            MEMORY.navigation_committed(self)
+        self.url = url
+        self.renderer_memory = memory
+        self.height = height
+        self.display_list = deserialize_display_list(display_list)
+        self.links = links
+        # The renderer has its own image cache; the browser still needs the
+        # images to rasterize them
+        for cmd in self.display_list:
+            if isinstance(cmd, DrawImage):
+                self.request_image(cmd.url)
+        return True
+
+    def image_loaded(self, load_id, image_url, data):
+        return IMAGE_CACHE.decode(image_url, data) is not None and load_id == self.load_id
+
+    # Layout happens in the renderer, which only needs to know the new width
+    def render(self):
+        if self.needs_layout:
+            self.send("resize", WIDTH)
+            self.needs_layout = False
+
+    # Links are hit tested locally so that middle clicks can open a tab
+    # without a round trip; everything else is forwarded
+    def click(self, x, y, mid_click=False):
+        for left, top, right, bottom, url in self.links:
+            if left <= x < right and top <= y + self.scroll < bottom:
+                if mid_click:
+                    return url
+                return self.load(url)
+        if not mid_click:
+            self.send("click", x, y, self.scroll)
+
+    def keypress(self, char):
+        self.send("keypress", char)
+
+    def go_back(self):
+        self.send("go_back")
+
+    def visible_links(self):
+        return [url for left, top, right, bottom, url in self.links
+                if bottom > self.scroll and top < self.scroll + self.tab_height]
+
+    def scrolldown(self):
+        max_y = max(self.height + 2*VSTEP - self.tab_height, 0)
+        self.scroll = min(self.scroll + SCROLL_HEIGHT, max_y)
+
+    def close(self):
+        self.load_id += 1
+        MEMORY.forget(self)
+        self.stop_renderer()
+
+    def stop_renderer(self):
+        self.send("quit")
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+    def memory_estimate(self):
+        if self.discarded: return 0
+        return self.renderer_memory + len(self.display_list) * DRAW_COMMAND_BYTES
+
+    # The page itself lives in the renderer, which only reports its estimate
+    def memory_usage(self):
+        usage = {
+            "url": str(self.url) if self.url else "",
+            "dom": None,
+            "styles": None,
+            "layout": None,
+            "display_list": sum(object_bytes(cmd) + object_bytes(cmd.rect)
+                                for cmd in self.display_list),
+            "responses": None,
+            "renderer": 0 if self.discarded else self.renderer_memory,
+        }
+        usage["total"] = sum(usage[category] or 0 for category in MEMORY_CATEGORIES)
+        return usage
+
+    def discard_layout(self):
+        self.display_list = []
+        self.needs_layout = True
+        self.send("discard_layout")
+
+    # Ending the renderer returns the whole page's memory to the OS
+    def discard_dom(self):
+        self.load_id += 1
+        self.stop_renderer()
+        self.display_list = []
+        self.links = []
+        self.renderer_memory = 0
+        self.discarded = True
+
+    def restore(self):
+        if not self.discarded: return
+        self.discarded = False
+        self.restore_scroll = self.scroll
+        self.renderer_load_id = None
+        self.start_renderer()
+        self.start_load(self.url, None)
+
+# Entry point of a renderer process: runs an ordinary Tab and streams its
+# display list back over the connection whenever it changes
+def renderer_main(connection, tab_height, width):
+    global WIDTH
+    WIDTH = width
+
+    # Layout needs a Tk interpreter for font metrics, but no window
+    tkinter.Tk().withdraw()
+    MEMORY.serves_pages = False
+
+    commit_queue = queue.Queue()
+    tab = Tab(tab_height, commit_queue)
+    while True:
+        if connection.poll(COMMIT_POLL_MS / 1000):
+            try:
+                kind, *args = connection.recv()
+            except EOFError:
+                break
+            if kind == "quit":
+                break
+            elif kind == "load":
+                tab.load(*args)
+            elif kind == "click":
+                x, y, tab.scroll = args
+                tab.click(x, y)
+            elif kind == "keypress":
+                tab.keypress(*args)
+            elif kind == "go_back":
+                tab.go_back()
+            elif kind == "resize":
+                WIDTH = args[0]
+                tab.needs_layout = True
+            elif kind == "discard_layout":
+                tab.discard_layout()
+                tab.needs_layout = False
+
+        # A loaded image changes the page without going through render, so
+        # anything a queued method reports as a change needs a new frame too
+        changed = False
+        while not commit_queue.empty():
+            _, method, args = commit_queue.get()
+            if method(*args):
+                changed = True
+
+        if tab.needs_layout:
+            tab.render()
+            changed = True
+        if changed:
+            # Nothing is laid out before the first commit or after a failed
+            # load, e.g. when the window is resized at startup
+            if tab.document is None:
+                tab.needs_layout = False
+            else:
+                connection.send((
+                    "frame", tab.url, tab.load_id, tab.document.height,
+                    serialize_display_list(tab.display_list),
+                    link_map(tab), tab.memory_estimate()
+                ))
+
+
+# Parsed stylesheet at a URL, as a (hash, rules) pair from STYLESHEETS
+def fetch_stylesheet(url):
+    return STYLESHEETS.parse(url.request())
+
+STYLESHEET_CACHE_SIZE = 64
+INLINE_STYLE_CACHE_SIZE = 1024
+
+# Parsed stylesheets keyed by a hash of their text, shared by all tabs, so a
+# site-wide stylesheet is parsed once per session. Also keeps the final
+# cascade-ordered rule list (default sheet plus a page's sheets) for each
+# combination of sheets it has seen, and the declarations of each inline
+# style attribute. Rule lists are tuples and inline declarations read-only
+# mappings, and neither may be modified.
+class StylesheetCache:
+    def __init__(self, size=STYLESHEET_CACHE_SIZE,
+                 inline_size=INLINE_STYLE_CACHE_SIZE):
+        self.size = size
+        self.inline_size = inline_size
+        self.sheets = collections.OrderedDict()
+        self.cascades = collections.OrderedDict()
+        self.inline_styles = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def parse(self, text):
+        key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        with self.lock:
+            if key in self.sheets:
+                self.sheets.move_to_end(key)
+                self.hits += 1
+                return key, self.sheets[key]
+        rules = tuple(CSSParser(text).parse())
+        with self.lock:
+            self.misses += 1
+            self.store(self.sheets, key, rules)
+        return key, rules
+
+    # Rules of the default stylesheet followed by each sheet's, sorted by
+    # priority. Sorting is stable, so later sheets still win ties.
+    def cascade(self, sheets):
+        key = tuple(sheet_key for sheet_key, _ in sheets)
+        with self.lock:
+            if key in self.cascades:
+                self.cascades.move_to_end(key)
+                return self.cascades[key]
+        rules = list(DEFAULT_STYLE_SHEET)
+        for _, sheet_rules in sheets:
+            rules.extend(sheet_rules)
+        rules = tuple(sorted(rules, key=cascade_priority))
+        with self.lock:
+            self.store(self.cascades, key, rules)
+        return rules
+
+    # Inline styles are short, so they are keyed by their text directly
+    def inline(self, text):
+        with self.lock:
+            if text in self.inline_styles:
+                self.inline_styles.move_to_end(text)
+                return self.inline_styles[text]
+        pairs = types.MappingProxyType(CSSParser(text).body())
+        with self.lock:
+            self.store(self.inline_styles, text, pairs, self.inline_size)
+        return pairs
 
-        # Layout nodes and print
-        self.render()
+    def store(self, cache, key, value, size=None):
+        cache[key] = value
+        cache.move_to_end(key)
+        if len(cache) > (size or self.size):
+            cache.popitem(last=False)
+
+STYLESHEETS = StylesheetCache()
+
+PRELOAD_WORKERS = 4
+PRELOAD_POOL = concurrent.futures.ThreadPoolExecutor(
+    max_workers=PRELOAD_WORKERS, thread_name_prefix="preload")
+
+# Looks for stylesheets and images in the raw HTML while it is still being
+# received, and starts fetching them before the tree is built. Only complete
+# tags are scanned; a tag split across two pieces waits for the next one.
+class PreloadScanner:
+    TAG = re.compile(r"<((?:link|img)\b[^>]*)>", re.IGNORECASE)
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.pending = ""
+        self.parser = HTMLParser("")    # For its attribute parsing
+        self.stylesheets = {}           # URL -> future of (hash, rules)
+        self.images = []
+
+    def feed(self, data):
+        text = self.pending + self.decoder.decode(data)
+        cut = text.rfind("<")
+        if cut != -1 and ">" not in text[cut:]:
+            text, self.pending = text[:cut], text[cut:]
+        else:
+            self.pending = ""
 
+        for match in self.TAG.finditer(text):
+            tag, attributes = self.parser.get_attributes(match.group(1))
+            try:
+                if tag == "link" and attributes.get("rel") == "stylesheet" and "href" in attributes:
+                    url = self.base_url.resolve(attributes["href"])
+                    if str(url) not in self.stylesheets:
+                        self.stylesheets[str(url)] = PRELOAD_POOL.submit(fetch_stylesheet, url)
+                elif tag == "img" and "src" in attributes:
+                    url = str(self.base_url.resolve(attributes["src"]))
+                    self.images.append(url)
+                    IMAGE_LOADER.fetch(url)
+            except Exception:
+                continue    # Preloading is only a hint
 
 class HTMLParser:
     SELF_CLOSING_TAGS = [
@@ -699,6 +2185,7 @@ class HTMLParser:
         self.body = body
         self.unfinished = []
     
+    @traced("HTMLParser.parse")
     def parse(self):
         text = ""
         in_tag = False
@@ -846,7 +2333,22 @@ class BlockLayout:
         self.small_caps = False       # Flag for small caps
         self.small_caps_size = 8
     
+    # Nested blocks are laid out from an explicit stack rather than by
+    # recursion, so deeply nested documents don't hit the recursion limit.
+    # A block's height is filled in once all of its children are done.
     def layout(self):
+        stack = [(self, False)]
+        while stack:
+            block, finished = stack.pop()
+            if finished:
+                block.height = sum([child.height for child in block.children])
+                continue
+            stack.append((block, True))
+            stack.extend((child, False) for child in reversed(block.start_layout()))
+
+    # Position this block and create its children. Lines are laid out right
+    # away; child blocks are returned for the caller to lay out in order.
+    def start_layout(self):
         self.x = self.parent.x
         self.width = self.parent.width
 
@@ -862,14 +2364,13 @@ class BlockLayout:
                 next = BlockLayout(child, self, previous, WIDTH)
                 self.children.append(next)
                 previous = next
-        else:
-            self.new_line()
-            self.recurse(self.node)
+            return self.children
 
+        self.new_line()
+        self.recurse(self.node)
         for child in self.children:
             child.layout()
-        
-        self.height = sum([child.height for child in self.children])
+        return []
 
     def layout_mode(self):
         if isinstance(self.node, Text):
@@ -879,7 +2380,7 @@ class BlockLayout:
             return "block"
         elif self.node.children:
             return "inline"
-        elif self.node.children or self.node.tag == "input":
+        elif self.node.children or self.node.tag in ["input", "img"]:
             return "inline"
         else:
             return "block"
@@ -893,36 +2394,45 @@ class BlockLayout:
         input = InputLayout(node, line, previous_word)
         line.children.append(input)
 
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int((float(node.style["font-size"][:-2])) * .75)
-        font = get_font(size, weight, style)
+        font = font_for(node)
 
         self.cursor_x += w + font.measure(" ")
 
-    def recurse(self, node):
-        if isinstance(node, Text):
-            if self.center_next_text:
-                self.center_text(node.text)     # Center this token's text
-                self.center_next_text = False  # Reset the flag
-            else:
-                for word in node.text.split():
-                    self.word(node, word)
-        else:
-            if node.tag == "br":
+    def image(self, node):
+        w, _ = image_size(node)
+        if self.cursor_x + w > self.width:
+            self.new_line()
+        line = self.children[-1]
+        previous_word = line.children[-1] if line.children else None
+        line.children.append(ImageLayout(node, line, previous_word))
+
+        font = font_for(node)
+
+        self.cursor_x += w + font.measure(" ")
+
+    def recurse(self, tree):
+        for node in walk_tree(tree):
+            if isinstance(node, Text):
+                if self.center_next_text:
+                    self.center_text(node.text)     # Center this token's text
+                    self.center_next_text = False  # Reset the flag
+                else:
+                    for word in node.text.split():
+                        self.word(node, word)
+            elif node.tag == "br":
                 self.new_line()
             elif node.tag == "input" or node.tag == "button":
                 self.input(node)
-            for child in node.children:
-                self.recurse(child)
+            elif node.tag == "img":
+                self.image(node)
                 
     def word(self, node, word):
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(node.style["font-size"][:-2]) * .75)
-        font = get_font(size, weight, style)
+        if EMOJI.may_contain_emoji(word):
+            pieces = EMOJI.split(word)
+            if any(kind == "emoji" for kind, _ in pieces):
+                return self.emoji_word(node, pieces)
+
+        font = font_for(node)
         w = font.measure(word)
 
         if self.small_caps: 
@@ -946,6 +2456,25 @@ class BlockLayout:
         line.children.append(text)
         self.cursor_x += w + font.measure(" ")
 
+    # A word made of text and emoji pieces, laid out without spaces in between
+    def emoji_word(self, node, pieces):
+        font = font_for(node)
+        w = sum(EMOJI_SIZE if kind == "emoji" else font.measure(value)
+                for kind, value in pieces)
+
+        if self.cursor_x + w > self.width:
+            self.new_line()
+
+        line = self.children[-1]
+        for i, (kind, value) in enumerate(pieces):
+            previous_word = line.children[-1] if line.children else None
+            if kind == "emoji":
+                piece = EmojiLayout(node, value, line, previous_word, joined=i > 0)
+            else:
+                piece = TextLayout(node, value, line, previous_word, joined=i > 0)
+            line.children.append(piece)
+        self.cursor_x += w + font.measure(" ")
+
     def self_rect(self):
         return Rect(self.x, self.y,
                     self.x + self.width, self.y + self.height)
@@ -1031,11 +2560,7 @@ class InputLayout:
         self.previous = previous
     
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        self.font = font_for(self.node)
 
         self.width = INPUT_WIDTH_PX
 
@@ -1096,14 +2621,20 @@ class LineLayout:
         else:
             self.y = self.parent.y
 
+        # Nothing fit on the line, e.g. a word wider than the page, or an
+        # inline box with no text such as <head>
+        if not self.children:
+            self.height = 0
+            return
+
         for word in self.children:
             word.layout()
         
-        max_ascent = max([word.font.metrics("ascent") for word in self.children])
+        max_ascent = max([word_ascent(word) for word in self.children])
         baseline = self.y + 1.25 * max_ascent
         for word in self.children:
-            word.y = baseline - word.font.metrics("ascent")
-        max_descent = max([word.font.metrics("descent") for word in self.children])
+            word.y = baseline - word_ascent(word)
+        max_descent = max([word_descent(word) for word in self.children])
 
         self.height = 1.25 * (max_ascent + max_descent)
     
@@ -1113,13 +2644,23 @@ class LineLayout:
     def paint(self):
         return []
 
+# Images sit on the baseline; everything else uses its font's metrics
+def word_ascent(word):
+    if isinstance(word, ImageLayout): return word.height
+    return word.font.metrics("ascent")
+
+def word_descent(word):
+    if isinstance(word, ImageLayout): return 0
+    return word.font.metrics("descent")
+
 class TextLayout:
-    def __init__(self, node, word, parent, previous):
+    def __init__(self, node, word, parent, previous, joined=False):
         self.node = node
         self.word = word
         self.children = []
         self.parent = parent
         self.previous = previous
+        self.joined = joined    # Continues the previous piece without a space
         self.x = None
         self.y = None
         self.width = None
@@ -1127,16 +2668,12 @@ class TextLayout:
         self.font = None
     
     def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": style = "roman"
-        size = int(float(self.node.style["font-size"][:-2]) * .75)
-        self.font = get_font(size, weight, style)
+        self.font = font_for(self.node)
 
         self.width = self.font.measure(self.word)
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = 0 if self.joined else self.previous.font.measure(" ")
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -1150,6 +2687,94 @@ class TextLayout:
         color = self.node.style["color"]
         return [DrawText(self.x, self.y, self.word, self.font, color)]
 
+class EmojiLayout:
+    def __init__(self, node, glyph, parent, previous, joined=False):
+        self.node = node
+        self.glyph = glyph      # File name of the emoji image
+        self.children = []
+        self.parent = parent
+        self.previous = previous
+        self.joined = joined
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
+        self.font = None
+
+    def layout(self):
+        # The surrounding text's font still decides the line's metrics
+        self.font = font_for(self.node)
+
+        self.width = EMOJI_SIZE
+
+        if self.previous:
+            space = 0 if self.joined else self.previous.font.measure(" ")
+            self.x = self.previous.x + space + self.previous.width
+        else:
+            self.x = self.parent.x
+
+        self.height = max(EMOJI_SIZE, self.font.metrics("linespace"))
+
+    def should_paint(self):
+        return True
+
+    def paint(self):
+        return [DrawEmoji(self.x, self.y, self.glyph)]
+
+IMAGE_PLACEHOLDER_SIZE = 16
+
+# Size of an <img>: its width/height attributes, else the decoded image's
+# size, else a small placeholder. A single attribute keeps the aspect ratio.
+def image_size(node):
+    image = IMAGE_CACHE.get(getattr(node, "image_url", None))
+    natural_w = image.width() if image else IMAGE_PLACEHOLDER_SIZE
+    natural_h = image.height() if image else IMAGE_PLACEHOLDER_SIZE
+    w = parse_dimension(node.attributes.get("width"))
+    h = parse_dimension(node.attributes.get("height"))
+    if w is None and h is None:
+        return natural_w, natural_h
+    if w is None:
+        w = h * natural_w // natural_h if image else h
+    if h is None:
+        h = w * natural_h // natural_w if image else w
+    return w, h
+
+def parse_dimension(value):
+    if value is None: return None
+    value = value.removesuffix("px")
+    return int(value) if value.isdigit() else None
+
+class ImageLayout:
+    def __init__(self, node, parent, previous):
+        self.node = node
+        self.url = getattr(node, "image_url", None)
+        self.children = []
+        self.parent = parent
+        self.previous = previous
+        self.x = None
+        self.y = None
+        self.width = None
+        self.height = None
+        self.font = None
+
+    def layout(self):
+        self.font = font_for(self.node)
+
+        self.width, self.height = image_size(self.node)
+
+        if self.previous:
+            space = self.previous.font.measure(" ")
+            self.x = self.previous.x + space + self.previous.width
+        else:
+            self.x = self.parent.x
+
+    def should_paint(self):
+        return True
+
+    def paint(self):
+        rect = Rect(self.x, self.y, self.x + self.width, self.y + self.height)
+        return [DrawImage(rect, self.url)]
+
 class DocumentLayout:
     def __init__(self, node):
         self.node = node
@@ -1160,6 +2785,7 @@ class DocumentLayout:
         self.width = None
         self.height = None
     
+    @traced("DocumentLayout.layout")
     def layout(self):
         child = BlockLayout(self.node, self, None, WIDTH)
         self.children.append(child)
@@ -1175,104 +2801,132 @@ class DocumentLayout:
     def paint(self):
         return []
 
+# The parser scans whole selectors and declarations with the regular
+# expressions below instead of looping over characters in Python. Comments
+# count as whitespace, and strings are skipped as a unit so that a ';' or
+# '}' inside quotes doesn't end a declaration. Every run of whitespace,
+# comments or skipped text is matched atomically, and a comment can only end
+# at its first '*/', so there is one way to split any input and a failed
+# match never retries the text it already covered.
+CSS_COMMENT = r"(?>/\*[^*]*\*+(?:[^/*][^*]*\*+)*/|/\*.*\Z)"
+CSS_STRING = r""""(?:[^"\\\n]|\\.)*"?|'(?:[^'\\\n]|\\.)*'?"""
+# Words may not contain underscores, which callers check for separately
+# since excluding them here makes every match much slower
+CSS_WORD = r"[\w#.%-]+"
+# Runs of whitespace and comments, with and without at least one character
+CSS_GAP = r"(?>\s*(?:{0}\s*)*)".format(CSS_COMMENT)
+CSS_SEPARATOR = r"(?>\s+(?:{0}\s*)*|(?:{0}\s*)+)".format(CSS_COMMENT)
+# Anything up to one of the given characters, stepping over strings and comments
+CSS_UNTIL = r"""(?>[^{chars}"'/]*(?:(?:{string}|{comment}|/)[^{chars}"'/]*)*)"""
+CSS_VALUE = CSS_UNTIL.format(
+    chars=re.escape(";{}"), string=CSS_STRING, comment=CSS_COMMENT)
+
+CSS_COMMENT_RE = re.compile(CSS_COMMENT, re.DOTALL)
+CSS_SPACE = re.compile(CSS_GAP, re.DOTALL)
+CSS_SELECTOR = re.compile(
+    r"({word}(?:{sep}{word})*){gap}\{{{gap}".format(
+        word=CSS_WORD, sep=CSS_SEPARATOR, gap=CSS_GAP),
+    re.DOTALL)
+CSS_DECLARATION = re.compile(
+    r"({word}){gap}:{gap}({value})(?:;{gap})?".format(
+        word=CSS_WORD, gap=CSS_GAP, value=CSS_VALUE),
+    re.DOTALL)
+# A run of well-formed declarations, each ending in a ';' or the end of the body
+CSS_BODY = re.compile(
+    r"(?:{word}{gap}:{gap}{value}(?:;{gap}|(?=\}})|\Z))*".format(
+        word=CSS_WORD, gap=CSS_GAP, value=CSS_VALUE),
+    re.DOTALL)
+CSS_VALUE_GAP = re.compile(
+    r"({})|(?:\s+|{})+".format(CSS_STRING, CSS_COMMENT), re.DOTALL)
+CSS_SKIP = {
+    chars: re.compile(CSS_UNTIL.format(
+        chars=re.escape(chars), string=CSS_STRING, comment=CSS_COMMENT),
+        re.DOTALL)
+    for chars in (";}", "}")
+}
+
 class CSSParser:
     def __init__(self, s):
         self.s = s
         self.i = 0
-    
-    # Increment index past every whitespace character
+
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
+        self.i = CSS_SPACE.match(self.s, self.i).end()
+
+    # Move to the next of the given characters outside of any string or
+    # comment, without consuming it
+    def ignore_until(self, chars):
+        self.i = CSS_SKIP[chars].match(self.s, self.i).end()
+        if self.i < len(self.s):
+            return self.s[self.i]
+        return None
 
-    # Increment index through any word character and store parsed data
-    # from where the function started to where it move
-    def word(self):
-        start = self.i
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
-        if not (self.i > start):
-            raise Exception("index i hasn't advanced")
-        return self.s[start:self.i]
-
-    # Increment index through a literal (e.g. ':')
-    def literal(self, literal):
-        if not (self.i < len(self.s) and self.s[self.i] == literal):
-            raise Exception("Not a literal")
-        self.i += 1
-    
-    # Parse property-value pair
-    def pair(self):
-        prop = self.word()
-        self.whitespace()
-        self.literal(':')
-        self.whitespace()
-        val = self.word()
-        return prop.casefold(), val
-    
-    # Parse sequences (e.g. 'style' attributes are a sequence of property-value pairs)
+    # Parse sequences (e.g. 'style' attributes are a sequence of
+    # property-value pairs). Values run up to the next ';' or '}' and may
+    # contain several tokens, with whitespace and comments between them
+    # collapsed to one space.
     def body(self):
         pairs = {}
-        while self.i < len(self.s) and self.s[self.i] != "}":
-            try:
-                prop, val = self.pair()
-                pairs[prop.casefold()] = val
-                self.whitespace()
-                self.literal(';')
+        s = self.s
+        self.whitespace()
+        while self.i < len(s) and s[self.i] != "}":
+            end = CSS_BODY.match(s, self.i).end()
+            for prop, val in CSS_DECLARATION.findall(s, self.i, end):
+                self.add_declaration(pairs, prop, val)
+            self.i = end
+            if end == len(s) or s[end] == "}": break
+            # Keep a declaration cut short by a stray '{', as in 'b:c {x}',
+            # then skip past the rest of it
+            match = CSS_DECLARATION.match(s, end)
+            if match and match.end() < len(s) and s[match.end()] == "{":
+                self.add_declaration(pairs, match.group(1), match.group(2))
+            why = self.ignore_until(";}")
+            if why == ";":
+                self.i += 1
                 self.whitespace()
-            except Exception:
-                why = self.ignore_until([';', "}"])
-                if why == ";":
-                    self.literal(";")
-                    self.whitespace()
-                else:
-                    break
-
+            else:
+                break
         return pairs
 
-    # Ignore at a character from a given character set 
-    # in order to ignore certain property-value pairs
-    def ignore_until(self, chars): 
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
-                self.i += 1
-        return None
-    
-    # Function to parse selectors
+    def add_declaration(self, pairs, prop, val):
+        val = val.strip()
+        if "/*" in val or "  " in val or "\n" in val or "\t" in val:
+            val = CSS_VALUE_GAP.sub(lambda m: m.group(1) or " ", val).strip()
+        if val and "_" not in prop:
+            pairs[prop.casefold()] = val
+
+    # Parse a selector and the '{' after it, returning None if it is
+    # malformed
     def selector(self):
-        out = TagSelector(self.word().casefold())
-        self.whitespace()
-        while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.casefold())
-            out = DescendantSelector(out, descendant)
-            self.whitespace()
-        return out
+        match = CSS_SELECTOR.match(self.s, self.i)
+        if not match: return None
+        self.i = match.end()
+        text = match.group(1)
+        if "_" in text: return None
+        if "/*" in text:
+            text = CSS_COMMENT_RE.sub(" ", text)
+        return descendant_selector(text.casefold().split())
 
     # Parse a sequence of selectors and block (a CSS file)
+    @traced("CSSParser.parse")
     def parse(self):
         rules = []
+        self.whitespace()
         while self.i < len(self.s):
-            try:
-                self.whitespace()
-                selector = self.selector()
-                self.literal("{")
-                self.whitespace()
+            selector = self.selector()
+            if selector:
                 body = self.body()
-                self.literal("}")
-                rules.append((selector, body))
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
+                if self.i < len(self.s) and self.s[self.i] == "}":
+                    self.i += 1
+                    rules.append((selector, body))
                     self.whitespace()
-                else:
-                    break
+                    continue
+            why = self.ignore_until("}")
+            if why == "}":
+                self.i += 1
+                self.whitespace()
+            else:
+                break
         return rules
 
 class TagSelector:
@@ -1297,6 +2951,21 @@ class DescendantSelector:
             node = node.parent
         return False
 
+# The selector for "tag1 tag2 ... tagN", and back
+def descendant_selector(tags):
+    out = TagSelector(tags[0])
+    for tag in tags[1:]:
+        out = DescendantSelector(out, TagSelector(tag))
+    return out
+
+def selector_tags(selector):
+    tags = []
+    while isinstance(selector, DescendantSelector):
+        tags.append(selector.descendant.tag)
+        selector = selector.ancestor
+    tags.append(selector.tag)
+    return tags[::-1]
+
 class DrawText:
     def __init__(self, x1, y1, text, font, color):
         self.rect = Rect(x1, y1,
@@ -1306,26 +2975,74 @@ class DrawText:
         self.bottom = y1 + font.metrics("linespace")
         self.color = color
 
-    def execute(self, scroll, canvas):
+    def serialize(self):
+        font = (self.font.cget("size"), self.font.cget("weight"), self.font.cget("slant"))
+        return ("text", self.rect.left, self.rect.top, self.text, font, self.color)
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_text(
             self.rect.left, self.rect.top - scroll,
             text=self.text,
             font=self.font,
             anchor='nw',
-            fill=self.color
+            fill=self.color,
+            tags=tags
         )
 
+class DrawEmoji:
+    def __init__(self, x1, y1, glyph):
+        self.rect = Rect(x1, y1, x1 + EMOJI_SIZE, y1 + EMOJI_SIZE)
+        self.glyph = glyph
+
+    def serialize(self):
+        return ("emoji", self.rect.left, self.rect.top, self.glyph)
+
+    def execute(self, scroll, canvas, tags=()):
+        canvas.create_image(
+            self.rect.left, self.rect.top - scroll,
+            image=EMOJI.image(self.glyph),
+            anchor='nw',
+            tags=tags
+        )
+
+# Draws an image from the image cache, or an outline while it is loading
+class DrawImage:
+    def __init__(self, rect, url):
+        self.rect = rect
+        self.url = url
+
+    def serialize(self):
+        r = self.rect
+        return ("image", r.left, r.top, r.right, r.bottom, self.url)
+
+    def execute(self, scroll, canvas, tags=()):
+        image = IMAGE_CACHE.get(self.url)
+        if image:
+            canvas.create_image(
+                self.rect.left, self.rect.top - scroll,
+                image=image,
+                anchor='nw',
+                tags=tags
+            )
+        else:
+            DrawOutline(self.rect, "gray", 1).execute(scroll, canvas, tags)
+
 class DrawRect:
     def __init__(self, rect, color):
         self.rect = rect 
         self.color = color
     
-    def execute(self, scroll, canvas):
+    def serialize(self):
+        r = self.rect
+        return ("rect", r.left, r.top, r.right, r.bottom, self.color)
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_rectangle(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
             width=0,
-            fill=self.color
+            fill=self.color,
+            tags=tags
         )
 
 class DrawOutline:
@@ -1334,12 +3051,17 @@ class DrawOutline:
         self.color = color
         self.thickness = thickness
     
-    def execute(self, scroll, canvas):
+    def serialize(self):
+        r = self.rect
+        return ("outline", r.left, r.top, r.right, r.bottom, self.color, self.thickness)
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_rectangle(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
             width=self.thickness,
-            outline=self.color
+            outline=self.color,
+            tags=tags
         )
 
 class DrawLine:
@@ -1348,14 +3070,90 @@ class DrawLine:
         self.color = color
         self.thickness = thickness
     
-    def execute(self, scroll, canvas):
+    def serialize(self):
+        r = self.rect
+        return ("line", r.left, r.top, r.right, r.bottom, self.color, self.thickness)
+
+    def execute(self, scroll, canvas, tags=()):
         canvas.create_line(
             self.rect.left, self.rect.top - scroll,
             self.rect.right, self.rect.bottom - scroll,
-            fill=self.color, width=self.thickness
+            fill=self.color, width=self.thickness,
+            tags=tags
         )
 
-DEFAULT_STYLE_SHEET = CSSParser(open("browser.css").read()).parse()
+# Display lists cross process boundaries as plain tuples, since Tk fonts
+# can't be pickled
+def serialize_display_list(display_list):
+    return [cmd.serialize() for cmd in display_list]
+
+def deserialize_display_list(data):
+    display_list = []
+    for kind, *args in data:
+        if kind == "text":
+            x, y, text, font, color = args
+            display_list.append(DrawText(x, y, text, get_font(*font), color))
+        elif kind == "rect":
+            left, top, right, bottom, color = args
+            display_list.append(DrawRect(Rect(left, top, right, bottom), color))
+        elif kind == "outline":
+            left, top, right, bottom, color, thickness = args
+            display_list.append(DrawOutline(Rect(left, top, right, bottom), color, thickness))
+        elif kind == "line":
+            display_list.append(DrawLine(*args))
+        elif kind == "emoji":
+            display_list.append(DrawEmoji(*args))
+        elif kind == "image":
+            left, top, right, bottom, url = args
+            display_list.append(DrawImage(Rect(left, top, right, bottom), url))
+    return display_list
+
+# Bounding boxes of every laid out word that is inside a link, together with
+# the link's resolved URL
+def link_map(tab):
+    links = []
+    for obj in walk_tree(tab.document):
+        if not isinstance(obj, (TextLayout, EmojiLayout, ImageLayout, InputLayout)): continue
+        elt = obj.node
+        while elt and not (isinstance(elt, Element) and elt.tag == "a" and "href" in elt.attributes):
+            elt = elt.parent
+        if elt:
+            url = tab.url.resolve(elt.attributes["href"])
+            links.append((obj.x, obj.y, obj.x + obj.width, obj.y + obj.height, url))
+    return links
+
+BROWSER_CSS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "browser.css")
+STYLE_CACHE = BROWSER_CSS + ".cache"
+STYLE_CACHE_VERSION = 1     # Bump when the parser's output changes
+
+# Loads the default stylesheet from a parsed copy next to it, parsing and
+# saving it if the copy is missing or stale. The copy is stamped with the
+# cache version, the marshal format and a hash of the source, and holds
+# [(tags, body)] for each rule.
+def load_default_style_sheet(path=BROWSER_CSS, cache=STYLE_CACHE):
+    with open(path, "rb") as f:
+        source = f.read()
+    stamp = "css {} {} {}\n".format(
+        STYLE_CACHE_VERSION, marshal.version, hashlib.sha1(source).hexdigest()).encode("ascii")
+    try:
+        with open(cache, "rb") as f:
+            if f.readline() == stamp:
+                return [(descendant_selector(tags), body) for tags, body in marshal.load(f)]
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+
+    rules = CSSParser(source.decode("utf-8")).parse()
+    try:
+        temp = "{}.{}".format(cache, os.getpid())
+        with open(temp, "wb") as f:
+            f.write(stamp)
+            marshal.dump([(selector_tags(selector), body) for selector, body in rules], f)
+        os.replace(temp, cache)
+    except OSError:
+        pass    # E.g. a read-only install; parse again next time
+    return rules
+
+DEFAULT_STYLE_SHEET = load_default_style_sheet()
 
 INHERITED_PROPERTIES = {
     "font-size": "16px",
@@ -1364,6 +3162,262 @@ INHERITED_PROPERTIES = {
     "color": "black",
 }
 
+EMOJI_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openmoji-16x16-color")
+EMOJI_SIZE = 16
+EMOJI_CACHE_SIZE = 512          # Decoded glyphs kept in memory
+VARIATION_SELECTOR = "\ufe0f"
+
+# Packed form of the emoji directory, written by pack_emoji.py: every PNG
+# back to back in one file, plus an index of
+#   magic, count, then per glyph: code point count (B), code points (I each),
+#   offset (I), length (I)
+# all little-endian
+EMOJI_PACK = EMOJI_DIRECTORY + ".pack"
+EMOJI_PACK_INDEX = EMOJI_DIRECTORY + ".idx"
+EMOJI_PACK_MAGIC = b"EMJ1"
+
+# Maps emoji sequences in text to the bundled openmoji images. The index is a
+# trie over code points built from the file names on first use; images are
+# only decoded when drawn, and kept in a bounded LRU cache.
+class EmojiAtlas:
+    def __init__(self, directory=EMOJI_DIRECTORY, cache_size=EMOJI_CACHE_SIZE,
+                 pack=EMOJI_PACK, pack_index=EMOJI_PACK_INDEX):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.pack_path = pack
+        self.pack_index_path = pack_index
+        self.pack = None        # Memory-mapped pack file, if there is one
+        self.glyphs = {}        # Glyph name -> (offset, length) in the pack
+        self.trie = None
+        self.first_chars = None
+        self.images = collections.OrderedDict()
+        self.decoded = 0
+
+    # Glyph names are the image file names, e.g. 1F469-1F3FE-200D-2764-FE0F.png
+    def load_index(self):
+        if os.path.exists(self.pack_path) and os.path.exists(self.pack_index_path):
+            sequences = self.read_pack_index()
+        else:
+            names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+            sequences = []
+            for filename in names:
+                name, ext = os.path.splitext(filename)
+                if ext != ".png": continue
+                try:
+                    sequences.append(([int(cp, 16) for cp in name.split("-")], filename))
+                except ValueError:
+                    continue
+
+        trie = {}
+        for codepoints, filename in sequences:
+            sequence = "".join(chr(cp) for cp in codepoints)
+            self.insert(trie, sequence, filename, replace=True)
+            # Text often leaves out the variation selector
+            stripped = sequence.replace(VARIATION_SELECTOR, "")
+            if stripped != sequence:
+                self.insert(trie, stripped, filename, replace=False)
+        self.trie = trie
+        if trie:
+            self.first_chars = re.compile("[" + "".join(re.escape(c) for c in trie) + "]")
+        else:
+            self.first_chars = re.compile("(?!)")   # Never matches
+
+    def read_pack_index(self):
+        with open(self.pack_index_path, "rb") as f:
+            data = f.read()
+        if data[:4] != EMOJI_PACK_MAGIC:
+            raise ValueError(f"{self.pack_index_path} is not an emoji pack index")
+        count, = struct.unpack_from("<I", data, 4)
+        position = 8
+        sequences = []
+        for _ in range(count):
+            n, = struct.unpack_from("<B", data, position)
+            codepoints = struct.unpack_from(f"<{n}I", data, position + 1)
+            offset, length = struct.unpack_from("<II", data, position + 1 + 4*n)
+            position += 1 + 4*n + 8
+            name = "-".join("%04X" % cp for cp in codepoints) + ".png"
+            self.glyphs[name] = (offset, length)
+            sequences.append((codepoints, name))
+
+        with open(self.pack_path, "rb") as f:
+            self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return sequences
+
+    def insert(self, trie, sequence, filename, replace):
+        # Lone ASCII characters such as "-" stay text
+        if len(sequence) == 1 and ord(sequence) < 0x80: return
+        node = trie
+        for char in sequence:
+            node = node.setdefault(char, {})
+        if replace or "" not in node:
+            node[""] = filename
+
+    # Cheap check so that ordinary words skip the trie walk
+    def may_contain_emoji(self, word):
+        if self.trie is None:
+            self.load_index()
+        return self.first_chars.search(word) is not None
+
+    # Longest emoji sequence starting at text[start]: (filename, end) or (None, None)
+    def match(self, text, start):
+        node = self.trie
+        filename, end = None, None
+        i = start
+        while i < len(text):
+            if text[i] in node:
+                node = node[text[i]]
+            elif text[i] != VARIATION_SELECTOR:
+                break
+            i += 1
+            if "" in node:
+                filename, end = node[""], i
+        # A trailing variation selector belongs to the emoji
+        if end is not None and text[end:end+1] == VARIATION_SELECTOR:
+            end += 1
+        return filename, end
+
+    # Split a word into ("text", string) and ("emoji", filename) pieces
+    def split(self, word):
+        if self.trie is None:
+            self.load_index()
+        pieces = []
+        text = ""
+        i = 0
+        while i < len(word):
+            filename, end = self.match(word, i)
+            if filename:
+                if text: pieces.append(("text", text))
+                text = ""
+                pieces.append(("emoji", filename))
+                i = end
+            else:
+                text += word[i]
+                i += 1
+        if text: pieces.append(("text", text))
+        return pieces
+
+    def image(self, filename):
+        if filename in self.images:
+            self.images.move_to_end(filename)
+            return self.images[filename]
+        if filename in self.glyphs:
+            # Only this glyph's bytes are read from the mapped pack
+            offset, length = self.glyphs[filename]
+            image = tkinter.PhotoImage(data=self.pack[offset:offset + length])
+        else:
+            image = tkinter.PhotoImage(file=os.path.join(self.directory, filename))
+        self.decoded += 1
+        self.images[filename] = image
+        if len(self.images) > self.cache_size:
+            self.images.popitem(last=False)
+        return image
+
+EMOJI = EmojiAtlas()
+
+IMAGE_WORKERS = 4
+IMAGE_RECENT_FETCHES = 64
+IMAGE_CACHE_BYTES = 32 * 1024 * 1024
+IMAGE_EVICTED_URLS = 1024
+
+# Width and height from the image header, for the formats Tk can decode
+def sniff_image_size(data):
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in [b"GIF87a", b"GIF89a"]:
+        return struct.unpack("<HH", data[6:10])
+    return None
+
+# Fetches images on a small thread pool. Requests for a URL that is already
+# being fetched share the same future.
+class ImageLoader:
+    def __init__(self, workers=IMAGE_WORKERS):
+        self.workers = workers
+        self.pool = None
+        self.in_flight = {}
+        # Finished fetches, kept briefly so that preloaded images are still
+        # around when the page that wanted them commits
+        self.recent = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def fetch(self, url):
+        with self.lock:
+            if url in self.in_flight:
+                return self.in_flight[url]
+            if url in self.recent:
+                return self.recent[url]
+            if not self.pool:
+                self.pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="image")
+            future = self.pool.submit(self.fetch_image, url)
+            self.in_flight[url] = future
+        future.add_done_callback(lambda f: self.forget(url))
+        return future
+
+    def forget(self, url):
+        with self.lock:
+            future = self.in_flight.pop(url, None)
+            if future and not future.exception():
+                self.recent[url] = future
+                if len(self.recent) > IMAGE_RECENT_FETCHES:
+                    self.recent.popitem(last=False)
+
+    def fetch_image(self, url):
+        data = URL(url).request(binary=True)
+        if not data or not sniff_image_size(data):
+            raise ValueError("unsupported image format")
+        return data
+
+# Decoded images by URL, shared by all tabs and evicted least recently used
+# first once their decoded size passes max_bytes. Images on screen are pinned,
+# and recently evicted URLs are remembered so that a tab drawing one again
+# can fetch it again. Main thread only, since it holds Tk images.
+class ImageCache:
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.images = collections.OrderedDict()
+        self.bytes = 0
+        self.pinned = set()
+        self.evicted = collections.OrderedDict()
+
+    def get(self, url):
+        if url not in self.images: return None
+        self.images.move_to_end(url)
+        return self.images[url]
+
+    def decode(self, url, data):
+        if url in self.images:
+            return self.get(url)
+        try:
+            image = tkinter.PhotoImage(data=data)
+        except tkinter.TclError:
+            return None
+        self.images[url] = image
+        self.evicted.pop(url, None)
+        self.bytes += image.width() * image.height() * 4
+        for old_url in list(self.images):
+            if self.bytes <= self.max_bytes: break
+            if old_url == url or old_url in self.pinned: continue
+            old = self.images.pop(old_url)
+            self.bytes -= old.width() * old.height() * 4
+            self.evicted[old_url] = True
+            if len(self.evicted) > IMAGE_EVICTED_URLS:
+                self.evicted.popitem(last=False)
+        return image
+
+    # Whether the URL was evicted and not yet asked for again
+    def take_evicted(self, url):
+        return self.evicted.pop(url, None) is not None
+
+IMAGE_LOADER = ImageLoader()
+IMAGE_CACHE = ImageCache()
+
+# The font a node's text is drawn in
+def font_for(node):
+    style = node.style["font-style"]
+    if style == "normal": style = "roman"
+    size = int(float(node.style["font-size"][:-2]) * .75)
+    return get_font(size, node.style["font-weight"], style)
+
 def get_font(size, weight, style):
     key = (size, weight, style)
     if key not in FONTS:
@@ -1373,46 +3427,49 @@ def get_font(size, weight, style):
     return FONTS[key][0]
 
 # Function that saves the parsed style attribute in the node's style field
-def style(node, rules):
-    node.style = {}
-    
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent:
-            node.style[property] = node.parent.style[property]
-        else:
-            node.style[property] = default_value
-    
-    for selector, body in rules:
-        if not selector.matches(node): continue
-        for property, value in body.items():
-            node.style[property] = value
-
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-style"]
-        else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
-        node_pct = float(node.style["font-size"][:-1]) / 100
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
-    for child in node.children:
-        style(child, rules)
+# Parents come before their children in a pre-order walk, so inherited
+# values are always ready
+@traced("style")
+def style(tree, rules):
+    for node in walk_tree(tree):
+        node.style = {}
+        
+        for property, default_value in INHERITED_PROPERTIES.items():
+            if node.parent:
+                node.style[property] = node.parent.style[property]
+            else:
+                node.style[property] = default_value
+        
+        for selector, body in rules:
+            if not selector.matches(node): continue
+            for property, value in body.items():
+                node.style[property] = value
+
+        if isinstance(node, Element) and "style" in node.attributes:
+            pairs = STYLESHEETS.inline(node.attributes["style"])
+            for property, value in pairs.items():
+                node.style[property] = value
+        if node.style["font-size"].endswith("%"):
+            if node.parent:
+                parent_font_size = node.parent.style["font-size"]
+            else:
+                parent_font_size = INHERITED_PROPERTIES["font-size"]
+            node_pct = float(node.style["font-size"][:-1]) / 100
+            parent_px = float(parent_font_size[:-2])
+            node.style["font-size"] = str(node_pct * parent_px) + "px"
 
+@traced("paint_tree")
 def paint_tree(layout_object, display_list):
-    if layout_object.should_paint():
-        display_list.extend(layout_object.paint())
-
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+    for obj in walk_tree(layout_object):
+        if obj.should_paint():
+            display_list.extend(obj.paint())
 
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-    for child in node.children:
-        print_tree(child, indent + 2)
+    indents = {id(node): indent}
+    for obj in walk_tree(node):
+        if obj is not node:
+            indents[id(obj)] = indents[id(obj.parent)] + 2
+        print(" " * indents[id(obj)], obj)
 
 def cascade_priority(rule):
     selector, body = rule
@@ -1420,11 +3477,31 @@ def cascade_priority(rule):
 
 # Function that turns a tree into a list of trees
 def tree_to_list(tree, list):
-    list.append(tree)
-    for child in tree.children:
-        tree_to_list(child, list)
+    list.extend(walk_tree(tree))
     return list
 
+# Pre-order traversal with an explicit stack, so deep trees don't hit the
+# recursion limit. Children of nodes for which prune(node) is true are
+# skipped, though the node itself is still yielded.
+def walk_tree(tree, prune=None):
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        yield node
+        if prune and prune(node): continue
+        stack.extend(reversed(node.children))
+
+# Post-order counterpart of walk_tree: every node comes after its children
+def walk_tree_postorder(tree, prune=None):
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if visited or (prune and prune(node)):
+            yield node
+            continue
+        stack.append((node, True))
+        stack.extend((child, False) for child in reversed(node.children))
+
 def is_entity(text):
     return text == "&lt;" or text == "&gt;"
 
@@ -1433,8 +3510,29 @@ def check_hyphen(word):
 
 if __name__ == "__main__":
     import sys
-    Browser().new_tab(URL(sys.argv[1]))
+    flags = [arg for arg in sys.argv[1:] if arg.startswith("--")]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    # --trace=<file> writes a Chrome trace of the session to the file on exit
+    trace = [flag.split("=", 1)[1] for flag in flags if flag.startswith("--trace=")]
+    if trace:
+        TRACER.enable()
+    # --tracemalloc records what each navigation allocated, for about:memory
+    if "--tracemalloc" in flags:
+        MEMORY.start_tracing()
+    # The first page downloads while the window is created. Renderer
+    # processes have their own cache, so this only helps a single process.
+    url = URL(args[0])
+    if "--multiprocess" not in flags:
+        request_early(url)
+    browser = Browser(
+        multiprocess="--multiprocess" in flags,
+        prefetch="--no-prefetch" not in flags,
+    )
+    browser.new_tab(url)
     tkinter.mainloop()
+    print("Prefetch:", browser.prefetcher.stats())
+    if trace:
+        TRACER.export(trace[0])
 
 # if __name__ == "__main__":
 #     import sys
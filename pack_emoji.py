@@ -0,0 +1,43 @@
+# Packs the openmoji directory into a single file plus a binary index, so
+# that the browser can memory-map one file instead of opening thousands of
+# small PNGs. See EmojiAtlas in browser.py for the format.
+#
+#   python pack_emoji.py [directory]
+
+import os
+import struct
+import sys
+
+from browser import EMOJI_DIRECTORY, EMOJI_PACK_MAGIC
+
+def pack(directory, pack_path, index_path):
+    entries = []
+    offset = 0
+    with open(pack_path, "wb") as out:
+        for filename in sorted(os.listdir(directory)):
+            name, ext = os.path.splitext(filename)
+            if ext != ".png": continue
+            try:
+                codepoints = [int(cp, 16) for cp in name.split("-")]
+            except ValueError:
+                continue
+            with open(os.path.join(directory, filename), "rb") as f:
+                data = f.read()
+            out.write(data)
+            entries.append((codepoints, offset, len(data)))
+            offset += len(data)
+
+    index = bytearray(EMOJI_PACK_MAGIC)
+    index += struct.pack("<I", len(entries))
+    for codepoints, offset, length in entries:
+        index += struct.pack(f"<B{len(codepoints)}I", len(codepoints), *codepoints)
+        index += struct.pack("<II", offset, length)
+    with open(index_path, "wb") as f:
+        f.write(index)
+    return len(entries), offset
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else EMOJI_DIRECTORY
+    directory = directory.rstrip("/\\")
+    count, size = pack(directory, directory + ".pack", directory + ".idx")
+    print(f"Packed {count} glyphs ({size} bytes) into {directory}.pack")
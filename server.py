@@ -1,63 +1,429 @@
 import socket
+import sys
+import os
+import json
+import gzip
+import zlib
+import collections
+import threading
+import concurrent.futures
 import urllib.parse
 
+# Connections are served concurrently, one worker thread each, and kept open
+# between requests. Once MAX_CONNECTIONS are open the accept loop waits for
+# one to close; a connection that sends nothing for IDLE_TIMEOUT seconds is
+# closed.
+MAX_CONNECTIONS = 256
+IDLE_TIMEOUT = 15
+MAX_REQUESTS_PER_CONNECTION = 1000
+
+class BadRequest(Exception):
+    pass
+
 def handle_connection(conx):
+    conx.settimeout(IDLE_TIMEOUT)
     req = conx.makefile("b")
-    reqline = req.readline().decode("latin-1").strip()
-    parts = reqline.split(" ", 2)
+    try:
+        for served in range(1, MAX_REQUESTS_PER_CONNECTION + 1):
+            last = served == MAX_REQUESTS_PER_CONNECTION
+            if not handle_request(conx, req, last): break
+    except (socket.timeout, ConnectionError):
+        pass
+    finally:
+        req.close()
+        conx.close()
+
+# Serve one request from the connection. Returns whether the connection
+# can be kept open for another.
+def handle_request(conx, req, last=False):
+    reqline = req.readline().decode("latin-1")
+    if not reqline: return False
+    try:
+        method, url, version, headers, body = read_request(reqline, req)
+    except BadRequest as e:
+        send_response(conx, "400 Bad Request", "<!doctype html><h1>{}</h1>".format(e), False)
+        return False
+
+    keep_alive = not last and wants_keep_alive(version, headers)
+    status, body, response_headers = do_request(method, url, headers, body)
+    # HTTP/1.0 clients can't read chunked responses
+    if version == "HTTP/1.0" and not isinstance(body, (str, bytes)):
+        body = b"".join(body)
+    body = negotiate_encoding(body, headers, response_headers)
+    send_response(conx, status, body, keep_alive, response_headers)
+    return keep_alive
+
+def read_request(reqline, req):
+    parts = reqline.strip().split(" ", 2)
     if len(parts) != 3:
-        raise ValueError(f"Invalid request line: {reqline}")
+        raise BadRequest(f"Invalid request line: {reqline.strip()}")
     method, url, version = parts
-    assert method in ["GET", "POST"] 
 
     headers = {}
     while True:
         line = req.readline().decode("latin-1")
-        if line == "\r\n": break
+        if line in ("\r\n", "\n", ""): break
+        if ":" not in line:
+            raise BadRequest(f"Invalid header: {line.strip()}")
         header, value = line.split(":", 1)
         headers[header.casefold()] = value.strip()
     if 'content-length' in headers:
-        length = int(headers['content-length'])
-        body = req.read(length).decode("latin-1")
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise BadRequest("Invalid Content-Length")
+        body = req.read(length).decode("utf-8", errors="replace")
     else:
         body = None
-    
-    status, body = do_request(method, url, headers, body)
+    return method, url, version, headers, body
+
+# HTTP/1.1 connections stay open unless the client asks otherwise, while
+# HTTP/1.0 ones have to ask to stay open
+def wants_keep_alive(version, headers):
+    connection = headers.get("connection", "").casefold()
+    if version == "HTTP/1.0":
+        return connection == "keep-alive"
+    return connection != "close"
+
+# Bodies may be given as text, as bytes that are already encoded, or as an
+# iterator of bytes, which is sent with chunked transfer encoding as it is
+# produced
+def send_response(conx, status, body, keep_alive, headers=None):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
     response = f"HTTP/1.1 {status}\r\n"
-    response += "Conent-Length: {}\r\n".format(len(body.encode("utf-8")))
-    response += "\r\n" + body
-    conx.send(response.encode("latin-1"))
-    conx.close()
+    response += "Content-Type: text/html; charset=utf-8\r\n"
+    for header, value in (headers or {}).items():
+        response += "{}: {}\r\n".format(header, value)
+    if status.startswith("304"):
+        pass    # Not Modified responses never have a body
+    elif isinstance(body, bytes):
+        response += "Content-Length: {}\r\n".format(len(body))
+    else:
+        response += "Transfer-Encoding: chunked\r\n"
+    response += "Connection: {}\r\n".format("keep-alive" if keep_alive else "close")
+    response += "\r\n"
+    if isinstance(body, bytes):
+        conx.sendall(response.encode("latin-1") + body)
+        return
+
+    conx.sendall(response.encode("latin-1"))
+    for chunk in body:
+        if not chunk: continue
+        conx.sendall("{:x}\r\n".format(len(chunk)).encode("latin-1") + chunk + b"\r\n")
+    conx.sendall(b"0\r\n\r\n")
 
+# Returns the status, the body and any extra response headers
 def do_request(method, url, headers, body):
-    if method == "GET" and url == "/":
-        return "200 OK", show_comments()
+    path, _, query = url.partition("?")
+    if method == "GET" and path == "/":
+        return show_page(urllib.parse.parse_qs(query), headers)
     elif method == "POST" and url == "/add":
         params = form_decode(body)
-        return "200 OK", add_entry(params)
+        add_entry(params)
+        # The page is then fetched like any other GET, so it can come from
+        # the page cache instead of being rendered for every post
+        return "303 See Other", b"", {"Location": "/"}
     else:
-        return "404 Not Found", not_found(url, method)
+        return "404 Not Found", not_found(url, method), {}
+
+# Responses are gzipped for clients that accept it. Guestbook pages arrive
+# here already compressed from the page cache; anything else big enough to
+# be worth it is compressed on the way out.
+GZIP_LEVEL = 6
+MIN_COMPRESS_SIZE = 256
+
+def accepts_gzip(headers):
+    for coding in headers.get("accept-encoding", "").split(","):
+        name, _, params = coding.partition(";")
+        if name.strip().casefold() != "gzip": continue
+        return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+def negotiate_encoding(body, headers, response_headers):
+    if "Content-Encoding" in response_headers: return body
+    if not isinstance(body, (str, bytes)) or not accepts_gzip(headers): return body
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    if len(body) < MIN_COMPRESS_SIZE: return body
+    response_headers["Content-Encoding"] = "gzip"
+    response_headers["Vary"] = "Accept-Encoding"
+    return gzip.compress(body, GZIP_LEVEL, mtime=0)
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+# Weak, since the compressed bytes of a page can differ between its
+# streamed and whole forms. A page's content only depends on the number of
+# entries, since they are never changed once added.
+def page_etag(version, after, limit, compressed):
+    return 'W/"{}-{}-{}{}"'.format(
+        version, after, "all" if limit is None else limit,
+        "-gzip" if compressed else "")
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match: return False
+    opaque = lambda tag: tag[2:] if tag.startswith("W/") else tag
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(opaque(tag) == opaque(etag) for tag in tags)
 
 def form_decode(body):
     params = {}
-    for field in body.split("&"):
+    for field in (body or "").split("&"):
+        if "=" not in field: continue
         name, value = field.split("=", 1)
         name = urllib.parse.unquote_plus(name)
         value = urllib.parse.unquote_plus(value)
         params[name] = value
     return params
 
-ENTRIES = [ 'Martin was here' ]
+ENTRY_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "guestbook.log")
+DEFAULT_ENTRIES = [ 'Martin was here' ]
+
+# Entries are stored as an append-only log with one JSON string per line.
+# Writers append their line right away and then wait for it to be synced to
+# disk, and a single fsync covers every line written before it started, so
+# concurrent posts share fsyncs instead of queueing up behind each other.
+class EntryLog:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.synced = threading.Condition(self.lock)
+        self.file = None
+        self.written = 0
+        self.durable = 0
+        self.syncing = False
+        self.fsyncs = 0
+
+    # Read back every complete entry. A torn write from a crash can only
+    # leave a partial line at the end, which is cut off.
+    def recover(self):
+        entries = []
+        good = 0
+        if os.path.exists(self.path):
+            with open(self.path, "rb") as f:
+                for line in f:
+                    if not line.endswith(b"\n"): break
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break
+                    if not isinstance(entry, str): break
+                    entries.append(entry)
+                    good += len(line)
+            size = os.path.getsize(self.path)
+            if size > good:
+                print("Dropping {} bytes of incomplete entries from {}".format(size - good, self.path))
+                os.truncate(self.path, good)
+        self.file = open(self.path, "ab", buffering=0)
+        self.written = self.durable = len(entries)
+        return entries
+
+    # Append an entry and return its sequence number, without waiting for
+    # it to reach the disk
+    def write(self, entry):
+        line = (json.dumps(entry) + "\n").encode("utf-8")
+        with self.lock:
+            view = memoryview(line)
+            while view:
+                view = view[self.file.write(view):]
+            self.written += 1
+            return self.written
+
+    # Wait until the entry with the given sequence number is on disk
+    def sync(self, seq):
+        with self.lock:
+            while self.durable < seq:
+                if self.syncing:
+                    self.synced.wait()
+                    continue
+                self.syncing = True
+                target = self.written
+                self.lock.release()
+                try:
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.lock.acquire()
+                    self.syncing = False
+                    self.synced.notify_all()
+                self.durable = target
+                self.fsyncs += 1
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+PAGE_HEADER = ("<!doctype html>"
+    "<form action=add method=post>"
+    "<p><input name=guest></p>"
+    "<p><button>Sign the book!</button></p>"
+    "</form>")
+
+def render_entry(entry):
+    return "<p>" + entry + "</p>"
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 64 * 1024
+COMPRESSED_PAGE_CACHE_SIZE = 64
+
+# The rendered page is kept as bytes and extended as entries are added, so
+# a GET never re-renders old entries. New entries show up as soon as they
+# are logged; the poster's request only returns once theirs is on disk.
+# Entry ids count up from 1 in log order, and offsets[i] is where the i-th
+# entry (from 0) starts in the rendered page, so any run of entries can be
+# sliced out of it directly. The version of a page is the number of entries
+# it was rendered from.
+#
+# The whole page is also gzipped as it grows: each entry is fed to one
+# compressor, and serving a version only flushes a copy of it onto the
+# output so far. Other pages are gzipped on request and cached by the
+# entries they hold, so adding an entry doesn't invalidate them.
+class Guestbook:
+    def __init__(self, log):
+        self.log = log
+        self.lock = threading.Lock()
+        self.entries = log.recover()
+        self.header = PAGE_HEADER.encode("utf-8")
+        self.body = bytearray(self.header)
+        self.offsets = [len(self.body)]
+        for entry in self.entries:
+            self.body += render_entry(entry).encode("utf-8")
+            self.offsets.append(len(self.body))
+        self.page = None
+        self.compressed = collections.OrderedDict()
+        self.deflate = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.deflated = bytearray(self.deflate.compress(bytes(self.body)))
+        self.compressed_page = None
+        if not self.entries:
+            for entry in DEFAULT_ENTRIES:
+                self.add(entry)
+
+    def add(self, entry):
+        fragment = render_entry(entry).encode("utf-8")
+        with self.lock:
+            seq = self.log.write(entry)
+            self.entries.append(entry)
+            self.body += fragment
+            self.offsets.append(len(self.body))
+            self.page = None
+            self.deflated += self.deflate.compress(fragment)
+            self.compressed_page = None
+        self.log.sync(seq)
+
+    def version(self):
+        with self.lock:
+            return len(self.entries)
+
+    def render(self):
+        return self.render_page()[1]
+
+    # Byte range of the entries after the given id, and the id to continue
+    # from if there are more
+    def span(self, after, limit):
+        start = min(after, len(self.entries))
+        end = len(self.entries) if limit is None else min(start + limit, len(self.entries))
+        more = end if end < len(self.entries) else None
+        return self.offsets[start], self.offsets[end], more
+
+    # Returns the page's version and its bytes, gzipped if compressed is set
+    def render_page(self, after=0, limit=None, compressed=False):
+        with self.lock:
+            version = len(self.entries)
+            start, end, more = self.span(after, limit)
+            if start == self.offsets[0] and more is None:
+                if not compressed:
+                    if self.page is None:
+                        self.page = bytes(self.body)
+                    return version, self.page
+                if self.compressed_page is None:
+                    self.compressed_page = bytes(self.deflated) + self.deflate.copy().flush()
+                return version, self.compressed_page
+
+            key = (start, end, more, limit)
+            if compressed and key in self.compressed:
+                self.compressed.move_to_end(key)
+                return version, self.compressed[key]
+            page = self.header + bytes(self.body[start:end]) + more_link(more, limit)
+        if not compressed:
+            return version, page
+
+        page = gzip.compress(page, GZIP_LEVEL, mtime=0)
+        with self.lock:
+            self.compressed[key] = page
+            if len(self.compressed) > COMPRESSED_PAGE_CACHE_SIZE:
+                self.compressed.popitem(last=False)
+        return version, page
+
+    # Returns the page's version and an iterator over its bytes
+    def stream(self, after=0, limit=None, chunk_size=STREAM_CHUNK_SIZE):
+        with self.lock:
+            version = len(self.entries)
+            start, end, more = self.span(after, limit)
+        return version, self.read_chunks(start, end, more, limit, chunk_size)
+
+    # Yields the page a piece at a time, holding the lock only while copying
+    # each piece
+    def read_chunks(self, start, end, more, limit, chunk_size):
+        yield self.header
+        while start < end:
+            with self.lock:
+                chunk = bytes(self.body[start:min(start + chunk_size, end)])
+            yield chunk
+            start += len(chunk)
+        yield more_link(more, limit)
+
+def more_link(after, limit):
+    if after is None: return b""
+    query = "after={}".format(after)
+    if limit is not None:
+        query += "&limit={}".format(limit)
+    return "<p><a href=\"/?{}\">More entries</a></p>".format(query).encode("utf-8")
+
+GUESTBOOK = None
 
 def show_comments():
-    out = "<!doctype html>"
-    out += "<form action=add method=post>"
-    out +=   "<p><input name=guest></p>"
-    out +=   "<p><button>Sign the book!</button></p>"
-    out += "</form>"
-    for entry in ENTRIES:
-        out += "<p>" + entry + "</p>"
-    return out
+    return GUESTBOOK.render()
+
+# GET / shows every entry. GET /?after=<id>&limit=<n> shows up to n entries
+# after the given one, and stream=1 sends the page in chunks as it is read
+# out. Streams default to every entry; other pages to PAGE_SIZE of them.
+# Clients that send back the ETag they have get a 304 if it is still
+# current.
+def show_page(params, headers):
+    stream = params.get("stream", ["0"])[0] == "1"
+    try:
+        after = max(int(params.get("after", ["0"])[0]), 0)
+        if "limit" in params:
+            limit = min(max(int(params["limit"][0]), 1), MAX_PAGE_SIZE)
+        else:
+            limit = None if stream or not params else PAGE_SIZE
+    except ValueError:
+        return "400 Bad Request", "<!doctype html><h1>Invalid page</h1>", {}
+
+    compressed = accepts_gzip(headers)
+    response_headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    etag = page_etag(GUESTBOOK.version(), after, limit, compressed)
+    if etag_matches(headers.get("if-none-match"), etag):
+        response_headers["ETag"] = etag
+        return "304 Not Modified", b"", response_headers
+
+    if stream:
+        version, body = GUESTBOOK.stream(after, limit)
+        if compressed:
+            body = gzip_chunks(body)
+    else:
+        version, body = GUESTBOOK.render_page(after, limit, compressed)
+    response_headers["ETag"] = page_etag(version, after, limit, compressed)
+    if compressed:
+        response_headers["Content-Encoding"] = "gzip"
+    return "200 OK", body, response_headers
 
 def not_found(url, method):
     out = "<!doctype html>"
@@ -66,20 +432,39 @@ def not_found(url, method):
 
 def add_entry(params):
     if 'guest' in params:
-        ENTRIES.append(params['guest'])
-    return show_comments()
+        GUESTBOOK.add(params['guest'])
+
+def serve(port=8000, max_connections=MAX_CONNECTIONS, log_path=ENTRY_LOG):
+    global GUESTBOOK
+    GUESTBOOK = Guestbook(EntryLog(log_path))
 
-if __name__ == "__main__":
     s = socket.socket(
         family=socket.AF_INET, 
         type=socket.SOCK_STREAM,
         proto=socket.IPPROTO_TCP)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-    s.bind(('', 8000))
-    s.listen()
+    s.bind(('', port))
+    s.listen(socket.SOMAXCONN)
+
+    pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max_connections, thread_name_prefix="connection")
+    slots = threading.BoundedSemaphore(max_connections)
+
+    def serve_connection(conx):
+        try:
+            handle_connection(conx)
+        finally:
+            slots.release()
 
     while True:
+        slots.acquire()
         conx, addr = s.accept()
-        print("Received connection from", addr)
-        handle_connection(conx)
+        conx.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        pool.submit(serve_connection, conx)
+
+if __name__ == "__main__":
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    port = int(args[0]) if args else 8000
+    print("Serving on port", port)
+    serve(port)